@@ -0,0 +1,80 @@
+import argparse, json, re, time, nltk
+
+from nltk.stem.snowball import SnowballStemmer
+from nltk.tokenize import word_tokenize
+from preprocesser import preprocess_many, get_document_text, stop_words, stem
+
+nltk.download('punkt')
+
+
+def nltk_preprocesser(text: str) -> list:
+    """
+    Preprocessing as it was done before, with a new stemmer and word_tokenize on every call
+    """
+
+    snow_stemmer = SnowballStemmer(language='english')
+
+    text = re.sub(r'\n|\r', ' ', text)       #Removes breaklines
+    text = re.sub(r'[^\w\s]', ' ', text)       #Removes punctuation
+    words = word_tokenize(text.lower())       #Tokenizes the text
+
+    filtered_sentence = []
+    for w in words:
+        if w not in stop_words:
+            filtered_sentence.append(snow_stemmer.stem(w))
+
+    return filtered_sentence
+
+
+def load_texts(corpus_path: str, number_of_documents: int) -> list[str]:
+    """
+    Reads the texts the indexer preprocesses for the first documents of the corpus
+    """
+
+    texts = []
+    with open(corpus_path, 'r') as f:
+        for line in f:
+            if len(texts) == number_of_documents:
+                break
+
+            doc = json.loads(line, strict=False)
+            texts.append(get_document_text(doc))
+
+    return texts
+
+
+def main(corpus_path: str, number_of_documents: int):
+    """
+    Times both preprocessers on the same texts and checks they agree
+    """
+
+    texts = load_texts(corpus_path, number_of_documents)
+
+    seconds = time.time()
+    expected = [nltk_preprocesser(text) for text in texts]
+    nltk_time = time.time() - seconds
+
+    number_of_tokens = sum(len(tokens) for tokens in expected)
+
+    # The first pass fills the memo table of the stems, the second one shows the steady state
+    for run in ("cold", "warm"):
+        seconds = time.time()
+        assert preprocess_many(texts) == expected
+        elapsed = time.time() - seconds
+
+        print(f"preprocess_many ({run}): {number_of_tokens/elapsed:.0f} tokens/sec ({nltk_time/elapsed:.1f}x)")
+
+    print(f"word_tokenize: {number_of_tokens/nltk_time:.0f} tokens/sec")
+    print(f"{len(texts)} documents, {number_of_tokens} tokens, {stem.cache_info().currsize} distinct stemmed tokens")
+
+
+# $ python3 bm_25_tf_idf/benchmark_preprocesser.py -c data/corpus.jsonl -n 10000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the text preprocessing of the indexer and the retriever.')
+
+    parser.add_argument('-c',dest='corpus_path',action='store',required=True,type=str)
+    parser.add_argument('-n',dest='number_of_documents',action='store',required=False,type=int,default=10000)
+
+    args = parser.parse_args()
+    main(args.corpus_path, args.number_of_documents)
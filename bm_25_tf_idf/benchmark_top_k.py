@@ -0,0 +1,82 @@
+import argparse, time
+
+import numpy as np
+
+from queue import PriorityQueue
+from top_k import TopK, select_top_k
+
+
+def priority_queue_top_k(doc_ids: list[int], scores: list[float], k: int) -> list[(int, float)]:
+    """
+    Top k selection as the rankers did it before, through a PriorityQueue drained one element at a time
+    """
+
+    r = PriorityQueue()
+    for doc_id, sd in zip(doc_ids, scores):
+        r.put((sd, doc_id))
+
+        if r.qsize() > k:
+            r.get()
+
+    results = []
+    while not r.empty():
+        score, doc_id = r.get()
+        results.append((doc_id, score))
+
+    return results[::-1]
+
+
+def heap_top_k(doc_ids: list[int], scores: list[float], k: int) -> list[(int, float)]:
+    """
+    Streaming top k selection with the heap of TopK
+    """
+
+    r = TopK(k)
+    for doc_id, sd in zip(doc_ids, scores):
+        r.push(sd, doc_id)
+
+    return r.results()
+
+
+def main(number_of_documents: int, cuts: list[int]):
+    """
+    Times every selector on the same scores and checks they agree
+    """
+
+    rng = np.random.default_rng(0)
+    doc_ids = np.arange(number_of_documents)
+    # Rounded so that ties, broken by doc id, also show up
+    scores = np.round(rng.gamma(2.0, 2.0, number_of_documents), 4)
+
+    doc_ids_list = doc_ids.tolist()
+    scores_list = scores.tolist()
+
+    for k in cuts:
+        timings = {}
+
+        seconds = time.time()
+        expected = priority_queue_top_k(doc_ids_list, scores_list, k)
+        timings["PriorityQueue"] = time.time() - seconds
+
+        seconds = time.time()
+        assert heap_top_k(doc_ids_list, scores_list, k) == expected
+        timings["heapq"] = time.time() - seconds
+
+        seconds = time.time()
+        assert select_top_k(doc_ids, scores, k) == expected
+        timings["argpartition"] = time.time() - seconds
+
+        for selector, elapsed in timings.items():
+            print(f"k={k} {selector}: {elapsed:.3f} seconds ({timings['PriorityQueue']/elapsed:.1f}x)")
+
+
+# $ python3 bm_25_tf_idf/benchmark_top_k.py -n 1000000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the top k selectors of the rankers.')
+
+    parser.add_argument('-n',dest='number_of_documents',action='store',required=False,type=int,default=1000000)
+    parser.add_argument('-k',dest='cuts',action='store',required=False,type=int,nargs='+',default=[100, 100000])
+
+    args = parser.parse_args()
+    main(args.number_of_documents, args.cuts)
@@ -0,0 +1,120 @@
+import os, json, shutil, logging
+
+from index_segments import SEGMENTS_MANIFEST
+
+
+# Progress of a build of the index, removed once the build is complete
+BUILD_MANIFEST = "build_manifest.json"
+
+# Folders of the intermediate files of a build
+BUILD_FOLDERS = ("runs/", "segments/", "doc_indexes/", "doc_lens/", "doc_store/", "position_ranges/")
+
+# Files of an index built by indexer.py, a new build removes the ones of the previous index so that none of them is left over
+INDEX_FILES = (
+    "inverted_index", "term_lexicon.txt", "document_lengths", "document_ids", "document_store", "document_offsets",
+    "impact_index", "impact_offsets", "positional_index", "positional_offsets", "index_statistics.txt", "index_metadata.json"
+)
+
+
+def corpus_signature(corpus_path: str) -> dict:
+    """
+    Identifies the version of a corpus file, a build is only resumed on the same one
+    """
+
+    stat = os.stat(corpus_path)
+
+    return {"path": os.path.abspath(corpus_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def new_build_manifest(settings: dict) -> dict:
+    return {"settings": settings, "partitions": None, "completed_partitions": [], "term_ranges": None, "completed_ranges": {}, "completed_stages": []}
+
+
+def read_build_manifest(index_path: str) -> dict:
+    """
+    Reads the progress of the build of the index, None when no build was left unfinished
+    """
+
+    manifest_path = os.path.join(index_path, BUILD_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path, 'r') as fp:
+        return json.load(fp)
+
+
+def save_build_manifest(index_path: str, manifest: dict) -> None:
+    """
+    Replaces the build manifest at once, a crash leaves either the old progress or the new one
+    """
+
+    manifest_path = os.path.join(index_path, BUILD_MANIFEST)
+    with open(manifest_path + ".tmp", 'w') as fp:
+        json.dump(manifest, fp)
+
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def load_build_manifest(index_path: str) -> dict:
+    """
+    Returns the progress of the current build, an empty one for builds not started by start_build
+    """
+
+    return read_build_manifest(index_path) or new_build_manifest(None)
+
+
+def clear_index(index_path: str) -> None:
+    """
+    Removes the intermediate files of a build and the previous index in index_path, with the segments and deletions of its updates
+    """
+
+    for folder in BUILD_FOLDERS:
+        shutil.rmtree(os.path.join(index_path, folder), ignore_errors=True)
+
+    for file_name in os.listdir(index_path):
+        file_path = os.path.join(index_path, file_name)
+        if file_name in INDEX_FILES or file_name == SEGMENTS_MANIFEST or file_name.startswith("deletions_"):
+            os.remove(file_path)
+        elif file_name.startswith("segment_") and os.path.isdir(file_path):
+            shutil.rmtree(file_path)
+
+
+def start_build(index_path: str, settings: dict) -> bool:
+    """
+    Resumes the unfinished build of the index when it was started with the same settings, else starts over
+    from an empty index, discarding its intermediate files and the files of the index built before; returns whether the build is resumed
+    """
+
+    manifest = read_build_manifest(index_path)
+    if manifest is not None and manifest["settings"] == settings:
+        logging.info(f"Resuming the build of {index_path}: {len(manifest['completed_partitions'])} partitions indexed, {len(manifest['completed_ranges'])} term ranges merged, stages {manifest['completed_stages']} completed")
+        return True
+
+    if manifest is not None:
+        logging.info(f"Settings of the build of {index_path} changed, starting over")
+
+    # The metadata is filled stage by stage, the optional stages of the previous index would otherwise be left in it
+    clear_index(index_path)
+
+    save_build_manifest(index_path, new_build_manifest(settings))
+
+    return False
+
+
+def complete_stage(index_path: str, manifest: dict, stage: str) -> None:
+    """
+    Records that a stage of the merge was completed
+    """
+
+    manifest["completed_stages"].append(stage)
+    save_build_manifest(index_path, manifest)
+
+
+def finish_build(index_path: str) -> None:
+    """
+    Removes the build manifest, the next build of the index starts from scratch
+    """
+
+    manifest_path = os.path.join(index_path, BUILD_MANIFEST)
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
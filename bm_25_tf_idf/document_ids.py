@@ -0,0 +1,121 @@
+import os, json
+
+import numpy as np
+
+from index_metadata import load_index_metadata, save_index_metadata
+
+
+# Corpus id of every document, indexed by the dense doc id stored in the postings
+DOC_IDS_DTYPE = np.dtype(">u4")
+
+# Orders the dense doc ids can be assigned in, documents close in the order get close ids and their gaps compress better
+DOC_ORDERS = ("id", "title")
+
+
+def check_doc_order(doc_order: str) -> None:
+    """
+    Raises a ValueError when the order of the doc ids is unknown
+    """
+
+    if doc_order not in DOC_ORDERS:
+        raise ValueError(f"Unknown doc id order {doc_order}, expected one of {', '.join(DOC_ORDERS)}")
+
+
+def read_titles(corpus_path: str) -> dict[int, str]:
+    """
+    Reads the title of every document of the corpus
+    """
+
+    titles = {}
+    with open(corpus_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                doc = json.loads(line, strict=False)
+                titles[int(doc['id'])] = doc['title'].lower()
+
+    return titles
+
+
+def assign_doc_ids(corpus_ids: np.ndarray, doc_order: str = "id", corpus_path: str = None) -> np.ndarray:
+    """
+    Returns the corpus ids in the order of the dense doc ids given to them, by corpus id or clustered by title
+    """
+
+    corpus_ids = np.sort(np.asarray(corpus_ids, dtype=np.int64))
+
+    if doc_order == "title":
+        titles = read_titles(corpus_path)
+        corpus_ids = np.array(sorted(corpus_ids.tolist(), key=lambda corpus_id: (titles.get(corpus_id, ""), corpus_id)), dtype=np.int64)
+
+    return corpus_ids
+
+
+def to_doc_ids(corpus_ids: np.ndarray, external_ids: np.ndarray, sorter: np.ndarray = None) -> np.ndarray:
+    """
+    Maps corpus ids to their dense doc ids, sorter is the argsort of corpus_ids when it was already computed
+    """
+
+    if sorter is None:
+        sorter = np.argsort(corpus_ids, kind="stable")
+
+    return sorter[np.searchsorted(corpus_ids, external_ids, sorter=sorter)]
+
+
+def save_document_ids(index_path: str, corpus_ids: np.ndarray, doc_order: str) -> None:
+    """
+    Saves the corpus id of every dense doc id, with the order they were assigned in in the index metadata
+    """
+
+    np.asarray(corpus_ids).astype(DOC_IDS_DTYPE).tofile(os.path.join(index_path, "document_ids"))
+    save_index_metadata(index_path, {"doc_order": doc_order})
+
+
+_document_ids = {}
+
+def load_document_ids(index_path: str) -> (np.ndarray, np.ndarray):
+    """
+    Returns the corpus id of every doc id and their argsort, mapped once per worker,
+    None for indexes built before the dense doc ids, whose postings hold the corpus ids
+    """
+
+    if index_path not in _document_ids:
+        doc_ids_path = os.path.join(index_path, "document_ids")
+
+        if "doc_order" not in load_index_metadata(index_path) or not os.path.isfile(doc_ids_path):
+            _document_ids[index_path] = None
+
+        elif os.path.getsize(doc_ids_path) == 0:
+            _document_ids[index_path] = (np.zeros(0, dtype=DOC_IDS_DTYPE), np.zeros(0, dtype=np.int64))
+
+        else:
+            corpus_ids = np.memmap(doc_ids_path, dtype=DOC_IDS_DTYPE, mode='r')
+            _document_ids[index_path] = (corpus_ids, np.argsort(corpus_ids, kind="stable"))
+
+    return _document_ids[index_path]
+
+
+def get_corpus_id(index_path: str, doc_id: int) -> int:
+    """
+    Returns the corpus id of a doc id of the index
+    """
+
+    document_ids = load_document_ids(index_path)
+
+    return doc_id if document_ids is None else document_ids[0].item(doc_id)
+
+
+def get_doc_id(index_path: str, corpus_id: int) -> int:
+    """
+    Returns the doc id the index gives to a corpus id, None when the corpus id is not in the index
+    """
+
+    document_ids = load_document_ids(index_path)
+    if document_ids is None:
+        return corpus_id
+
+    corpus_ids, sorter = document_ids
+    position = int(np.searchsorted(corpus_ids, corpus_id, sorter=sorter))
+    if position == len(corpus_ids) or corpus_ids[sorter[position]] != corpus_id:
+        return None
+
+    return int(sorter[position])
@@ -0,0 +1,62 @@
+import os, json
+
+import numpy as np
+
+from index_metadata import load_index_metadata, save_index_metadata
+
+
+# Document lengths indexed by doc id, zero for ids without a document
+DOC_LENS_DTYPE = np.dtype(">u4")
+
+
+def save_doc_lens(index_path: str, doc_lens: np.ndarray, number_of_documents: int, avg_doc_len: float) -> None:
+    """
+    Saves the document lengths as a binary array, with the collection size and average length in the index metadata
+    """
+
+    np.asarray(doc_lens).astype(DOC_LENS_DTYPE).tofile(os.path.join(index_path, "document_lengths"))
+    save_index_metadata(index_path, {"number_of_documents": number_of_documents, "avg_doc_len": avg_doc_len})
+
+
+def read_json_doc_lens(index_path: str) -> (np.ndarray, int, float):
+    """
+    Reads the document lengths of indexes built before the binary array, one json line per document
+    """
+
+    ids = []; lens = []
+    with open(os.path.join(index_path, "document_lens"), "r") as f:
+        for line in f:
+            doc_len = json.loads(line)
+            ids.append(int(doc_len["id"]))
+            lens.append(int(doc_len["len"]))
+
+    doc_lens = np.zeros(max(ids, default=-1) + 1, dtype=DOC_LENS_DTYPE)
+    doc_lens[ids] = lens
+
+    return doc_lens, len(ids), sum(lens)/len(ids)
+
+
+_document_lengths = {}
+
+def load_document_lengths(index_path: str) -> (np.ndarray, int, float):
+    """
+    Returns the document lengths array, the number of documents and the average document length,
+    the array is mapped into memory once per worker and its pages are shared by every worker
+    """
+
+    if index_path not in _document_lengths:
+        metadata = load_index_metadata(index_path)
+        doc_lens_path = os.path.join(index_path, "document_lengths")
+
+        if "avg_doc_len" not in metadata or not os.path.isfile(doc_lens_path):
+            _document_lengths[index_path] = read_json_doc_lens(index_path)
+
+        else:
+            if os.path.getsize(doc_lens_path) == 0:
+                doc_lens = np.zeros(0, dtype=DOC_LENS_DTYPE)
+            else:
+                doc_lens = np.memmap(doc_lens_path, dtype=DOC_LENS_DTYPE, mode='r')
+
+            _document_lengths[index_path] = (doc_lens, metadata["number_of_documents"], metadata["avg_doc_len"])
+
+    return _document_lengths[index_path]
@@ -1,123 +1,250 @@
-import os, time, json, math, logging, argparse, re
+import os, time, json, math, logging, argparse, re, mmap
 
-from queue import PriorityQueue
-from multiprocessing import Lock
+import numpy as np
 
-def decode_from_binary(byte_array: bytes):
+from lexicon import load_lexicon
+from postings import decode_postings, open_cursor, read_impact_segments, decode_impact_segment, PostingCursor, ArrayCursor, BLOCK_SIZE, END_OF_LIST
+from index_metadata import load_index_metadata
+from document_lengths import load_document_lengths
+from document_ids import load_document_ids
+from index_segments import load_segments, refresh_segments
+from positional_index import load_positional_index
+from top_k import TopK, select_top_k
+from posting_cache import get_posting_cache
+
+# Relative slack given to score upper bounds, so that summing them in another order never prunes a document
+SCORE_SLACK = 1e-9
+
+# The TAAT accumulates over the candidate doc ids when there are this many times fewer postings than documents
+SPARSE_ACCUMULATOR_RATIO = 16
+
+# Scores written for every query by the features mode, C for conjunctive and D for disjunctive matching
+FEATURE_MATCHINGS = ("C", "D")
+FEATURE_RANKERS = ("BM25", "TFIDF")
+FEATURE_HEADER = "QueryId,EntityId," + ",".join(f"Relevance {matching}_{ranker}" for ranker in FEATURE_RANKERS for matching in FEATURE_MATCHINGS) + ",MatchedTerms,DocLen,IdfSum"
+
+# Written after the other features when the index has positions
+POSITIONAL_FEATURES = ("Proximity", "PhraseMatches")
+
+# Documents of the features mode, in decreasing order of disjunctive BM25, whose positions are decoded, the others get zero
+PROXIMITY_DEPTH = 1000
+
+
+_index_files = {}
+
+def retrieve_word_bytes(index_path: str, byte_start: int, byte_end: int) -> bytes:
     """
-    Decodes a byte array into a word id and a list of documents
+    Reads the encoded inverted list stored between the given offsets, from the index file mapped once per worker
     """
-    
-    word_id = int.from_bytes(byte_array[:4], "big")
-    number_of_docs = int.from_bytes(byte_array[4:8], "big")
-    docs = []
-    for i in range(number_of_docs):
-        doc_id = int.from_bytes(byte_array[8 + i*6:12 + i*6], "big")
-        freq = int.from_bytes(byte_array[12 + i*6:14 + i*6], "big")
-        docs.append({"id": doc_id, "freq": freq})
-    
-    return word_id, docs
+
+    if index_path not in _index_files:
+        with open(index_path, 'rb') as index_file:
+            _index_files[index_path] = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return _index_files[index_path][byte_start:byte_end]
 
 
-def retrieve_word_postings(index_path: str, byte_start: int, byte_end: int) -> dict:
+def retrieve_word_postings(index_path: str, byte_start: int, byte_end: int, metadata: dict) -> (np.ndarray, np.ndarray):
     """
     Retrieves the inverted list for a given word id
     """
 
-    with open(index_path, 'rb') as index_file:
-        
-        index_file.seek(byte_start)
-        byte_array = index_file.read(byte_end - byte_start)
-        
-        retrieved_word_id, retrieved_docs = decode_from_binary(byte_array)
+    byte_array = retrieve_word_bytes(index_path, byte_start, byte_end)
+    retrieved_word_id, doc_ids, freqs = decode_postings(byte_array, metadata["format_version"], metadata.get("block_size", BLOCK_SIZE))
 
-        return  retrieved_docs
+    return doc_ids, freqs
 
-def get_term_byte_start(term_lexicon_path: str, term: str) -> (str, str, str, str, str):
+
+def resolve_index(index_path: str) -> (str, object):
+    """
+    Returns the path to read the index from with its segments, None when it is read as a plain index:
+    an index that was never updated or a single segment without deletions; a query resolves the index once
+    and hands both to every function it calls, so that it only sees one generation of the segments
     """
-    Binary search for word in lexicon file.
-    """    
-    
-    with open(term_lexicon_path, 'r') as lexicon_file:
-        lexicon = lexicon_file.read().splitlines()
-        low = 0; high = len(lexicon) - 1
 
-        while (low <= high):
-            mid = math.floor((low + high)/2)
-            current_term = lexicon[mid].split(" ")[0]
-            
-            if (term == current_term):
-                return lexicon[mid].split(" ")
-            
-            elif (term > current_term):
-                low = mid + 1
-            
-            else:
-                high = mid - 1
+    segments = load_segments(index_path)
+    if segments is not None and segments.is_single():
+        return segments.paths[0], None
+
+    return index_path, segments
+
+
+def get_document_lengths(index_path: str, segments = None) -> (np.ndarray, int, float):
+    """
+    Returns the document lengths, the number of documents and the average document length, over every segment of an updated index
+    """
 
-    return [None] * 5
+    if segments is None:
+        return load_document_lengths(index_path)
 
+    return segments.doc_lens, segments.number_of_documents, segments.avg_doc_len
 
-def get_inverted_list(index_path: str, term: str, index_lock: Lock, lexicon_lock: Lock) -> list:
+
+def get_tie_keys(index_path: str, segments = None) -> np.ndarray:
     """
-    Returns the inverted list for a given term
+    Returns the corpus id of every doc id when the doc ids are not in corpus id order, None when they are:
+    the rankers break score ties by corpus id, so that the order of the doc ids never changes the results
     """
 
+    if segments is not None:
+        return None if segments.in_corpus_id_order else segments.corpus_ids
+
+    document_ids = load_document_ids(index_path)
+    if document_ids is None or load_index_metadata(index_path).get("doc_order", "id") == "id":
+        return None
+
+    return document_ids[0]
+
+
+def get_segmented_inverted_list(index_path: str, segments, term: str) -> (np.ndarray, np.ndarray, int):
+    """
+    Concatenates the inverted lists of a term in every segment, shifted to the doc ids of the index, without the deleted documents
+    """
+
+    posting_cache = get_posting_cache()
+    cache_key = (index_path, segments.generation, term)
+    if posting_cache.is_enabled():
+        inverted_list = posting_cache.get(cache_key)
+        if inverted_list is not None:
+            return inverted_list
+
+    doc_ids = []; freqs = []
+    for segment_path, base in zip(segments.paths, segments.bases.tolist()):
+        found_term, term_id, byte_start, byte_end, tfc = load_lexicon(segment_path).lookup(term)
+        if found_term is not None:
+            segment_doc_ids, segment_freqs = retrieve_word_postings(os.path.join(segment_path, 'inverted_index'), byte_start, byte_end, load_index_metadata(segment_path))
+            doc_ids.append(segment_doc_ids + base); freqs.append(segment_freqs)
+
+    if not doc_ids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 1
+
+    doc_ids = np.concatenate(doc_ids); freqs = np.concatenate(freqs)
+    if segments.has_deletions:
+        live = ~segments.deleted[doc_ids]
+        doc_ids = doc_ids[live]; freqs = freqs[live]
+
+    # The document frequency only counts the documents still in the index
+    tfc = max(len(doc_ids), 1)
+
+    if posting_cache.is_enabled():
+        posting_cache.put(cache_key, doc_ids, freqs, tfc)
+
+    return doc_ids, freqs, tfc
+
+
+def get_inverted_list(index_path: str, term: str, inverted_lists: dict = None, segments = None) -> (np.ndarray, np.ndarray, int):
+    """
+    Returns the doc ids and frequencies of the inverted list for a given term,
+    from inverted_lists when the list was already fetched for a batch of queries or else from the posting cache
+    """
+
+    if inverted_lists is not None and term in inverted_lists:
+        return inverted_lists[term]
+
+    if segments is not None:
+        return get_segmented_inverted_list(index_path, segments, term)
+
     inverted_index_path = os.path.join(index_path, 'inverted_index')
-    term_lexicon_path = os.path.join(index_path, 'term_lexicon.txt')
 
-    with lexicon_lock:
-        term, term_id, byte_start, byte_end, tfc = get_term_byte_start(term_lexicon_path, term)
-        if (term == None):
-            # print("Term not found in lexicon")
-            return [], 1
+    term, term_id, byte_start, byte_end, tfc = load_lexicon(index_path).lookup(term)
+    if (term == None):
+        # print("Term not found in lexicon")
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 1
+
+    posting_cache = get_posting_cache()
+    if posting_cache.is_enabled():
+        inverted_list = posting_cache.get((index_path, term_id))
+        if inverted_list is not None:
+            return inverted_list
 
+    doc_ids, freqs = retrieve_word_postings(inverted_index_path, byte_start, byte_end, load_index_metadata(index_path))
 
+    if posting_cache.is_enabled():
+        posting_cache.put((index_path, term_id), doc_ids, freqs, tfc)
+
+    return doc_ids, freqs, tfc
+
+
+def get_posting_cursor(index_path: str, term: str, inverted_lists: dict = None, segments = None) -> (PostingCursor, int):
+    """
+    Returns a cursor over the inverted list of a given term, blocks are only decoded when the cursor reaches them
+    unless the list comes decoded from a batch of queries or from the posting cache
+    """
+
+    inverted_index_path = os.path.join(index_path, 'inverted_index')
+    metadata = load_index_metadata(index_path)
+
+    if (inverted_lists is not None and term in inverted_lists) or get_posting_cache().is_enabled() or segments is not None:
+        doc_ids, freqs, tfc = get_inverted_list(index_path, term, inverted_lists, segments)
+        return ArrayCursor(doc_ids, freqs, metadata.get("block_size", BLOCK_SIZE)), tfc
+
+    term, term_id, byte_start, byte_end, tfc = load_lexicon(index_path).lookup(term)
+    if (term == None):
+        return ArrayCursor(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)), 1
+
+    byte_array = retrieve_word_bytes(inverted_index_path, byte_start, byte_end)
+
+    return open_cursor(byte_array, metadata["format_version"], metadata.get("block_size", BLOCK_SIZE)), tfc
+
+
+def fetch_inverted_lists(index_path: str, queries: list[list[str]], segments = None) -> dict[str, (np.ndarray, np.ndarray, int)]:
+    """
+    Reads and decodes the inverted list of every distinct term of the queries once, from the index path and segments given by resolve_index
+    """
 
-    with index_lock:
-        word_postings = retrieve_word_postings(inverted_index_path, int(byte_start), int(byte_end))
+    inverted_lists = {}
+    for query in queries:
+        for term in query:
+            if term not in inverted_lists:
+                inverted_lists[term] = get_inverted_list(index_path, term, segments = segments)
 
-    return word_postings, tfc
+    return inverted_lists
     
 
-def get_valid_documents(postings_for_all_tokens: list[list], matching: str) -> list[(str, int)]:
+def get_valid_documents(cursors: list[PostingCursor], matching: str):
     """
-    Returns a list of documents that contain all the terms in the query
+    Yields the documents that should be scored for the query terms, in increasing doc id order
     """
 
-    cleaned_postings = []
-    for posting in postings_for_all_tokens:
-        cleaned_postings.append([int(doc["id"]) for doc in posting])
+    if not cursors:
+        return
 
     if matching == "conjuntive_daat":
-        return list(set.intersection(*map(set, cleaned_postings)))
+        # Leapfrogs from the shortest list, every other list skips whole blocks up to the candidate
+        cursors = sorted(cursors, key=len)
+        doc_id = cursors[0].doc()
+
+        while doc_id != END_OF_LIST:
+            for cursor in cursors[1:]:
+                next_doc_id = cursor.advance(doc_id)
+                if next_doc_id != doc_id:
+                    break
+            else:
+                yield doc_id
+                doc_id = cursors[0].next()
+                continue
+
+            doc_id = cursors[0].advance(next_doc_id)
 
     elif matching == "disjunctive_daat":
-        return list(set.union(*map(set, cleaned_postings)))
+        doc_id = min(cursor.doc() for cursor in cursors)
 
-    else:
-        return []
+        while doc_id != END_OF_LIST:
+            yield doc_id
+            for cursor in cursors:
+                if cursor.doc() == doc_id:
+                    cursor.next()
 
+            doc_id = min(cursor.doc() for cursor in cursors)
 
-def skip_forward_to_document(doc_id: str, term_posting: list[dict]) -> int:
+
+def skip_forward_to_document(doc_id: int, cursor: PostingCursor) -> int:
     """
     Skips forward in the inverted list to the document with the given id
     """
 
-    low = 0; high = len(term_posting) - 1
-    
-    while (low <= high):
-        mid = math.floor((low + high)/2)
-        current_term = term_posting[mid]['id']
-        
-        if (doc_id == current_term):
-            return int(term_posting[mid]['freq'])
-        
-        elif (doc_id > current_term):
-            low = mid + 1
-        
-        else:
-            high = mid - 1
+    if cursor.advance(doc_id) == doc_id:
+        return cursor.freq()
 
     return 0
 
@@ -139,78 +266,611 @@ def tf_idf(term_frequency: float, term_idf: float) -> float:
 
 
 
-def daat(index_path: str, query: list[str], doc_lens: dict[int, int], k: int, matching: str, ranker: str, index_lock: Lock, lexicon_lock: Lock) -> PriorityQueue:
+def daat(index_path: str, query: list[str], k: int, matching: str, ranker: str, inverted_lists: dict = None, segments = None) -> list[(int, float)]:
     """
     This function implements the DAAT algorithm
     """
 
     l = []
     idfs = {}
-    r = PriorityQueue()
-    avg_lens = sum(doc_lens.values())/len(doc_lens)
+    r = TopK(k, get_tie_keys(index_path, segments))
+    doc_lens, number_of_documents, avg_lens = get_document_lengths(index_path, segments)
 
     for term in query:                                                            # For each term in que query
-        term_postings, tfc = get_inverted_list(
+        cursor, tfc = get_posting_cursor(
             index_path, 
             term,
-            index_lock, 
-            lexicon_lock    
+            inverted_lists,
+            segments
         )                  
-        l.append(term_postings)
-        idfs[term] = math.log10(len(doc_lens)/int(tfc))                           # We calculate its idf
+        l.append(cursor)
+        idfs[term] = math.log10(number_of_documents/int(tfc))                     # We calculate its idf
 
-    valid_documents = get_valid_documents(l, matching)                                      # So to be conjuctive we pick only the docs that have all query terms
-    for doc_id in valid_documents:                                                # For each valid document
+    for doc_id in get_valid_documents(l, matching):                               # So to be conjuctive we only stop at docs that have all query terms
         
         sd = 0
-        for idx, term_postings in enumerate(l):                                   # We go through each inverted list
+        doc_len = doc_lens.item(doc_id)
+        for idx, cursor in enumerate(l):                                          # We go through each inverted list
             term = query[idx]                                                     # Get the term
-            weight = skip_forward_to_document(doc_id, term_postings)              # Get number of times the term appears in the current document
+            weight = skip_forward_to_document(doc_id, cursor)                     # Get number of times the term appears in the current document
 
             # Then calculate the score for the current document and current term
-            current_score = bm25(idfs[term], weight, doc_lens[doc_id], avg_lens) if ranker == 'BM25' else tf_idf(weight, idfs[term])
+            current_score = bm25(idfs[term], weight, doc_len, avg_lens) if ranker == 'BM25' else tf_idf(weight, idfs[term])
             sd += current_score
             
-        r.put((sd, doc_id))
+        r.push(sd, doc_id)
+
+
+    return r.results()
+
+
+def accumulate_scores(index_path: str, query: list[str], rankers: list[str], inverted_lists: dict = None, segments = None) -> (np.ndarray, dict[str, np.ndarray], np.ndarray, np.ndarray):
+    """
+    Adds the scores of each term for every ranker to accumulators indexed by doc id, reading each inverted list once,
+    returns the accumulated doc ids with their scores, number of matched terms and summed idf of the matched terms
+    """
 
-        if r.qsize() == k:
-            r.get()
+    l = []
+    idfs = []
+    doc_lens, number_of_documents, avg_lens = get_document_lengths(index_path, segments)
+
+    for term in query:
+        doc_ids, freqs, tfc = get_inverted_list(index_path, term, inverted_lists, segments)
+        l.append((doc_ids, freqs))
+        idfs.append(math.log10(number_of_documents/int(tfc)))
+
+    # Small candidate sets are accumulated over their own doc ids instead of the whole collection
+    number_of_postings = sum(len(doc_ids) for doc_ids, _ in l)
+    if l and number_of_postings * SPARSE_ACCUMULATOR_RATIO < len(doc_lens):
+        documents = np.unique(np.concatenate([doc_ids for doc_ids, _ in l]))
+        sparse = True
+    else:
+        documents = np.arange(len(doc_lens))
+        sparse = False
+
+    scores = {ranker: np.zeros(len(documents), dtype=np.float64) for ranker in rankers}
+    matched_terms = np.zeros(len(documents), dtype=np.int64)
+    idf_sums = np.zeros(len(documents), dtype=np.float64)
+
+    for idx, (doc_ids, freqs) in enumerate(l):                                    # Terms are added in query order, as the DAAT sums them
+        positions = np.searchsorted(documents, doc_ids) if sparse else doc_ids
 
+        for ranker in rankers:
+            scores[ranker][positions] += bm25(idfs[idx], freqs, doc_lens[doc_ids], avg_lens) if ranker == 'BM25' else tf_idf(freqs, idfs[idx])
+        matched_terms[positions] += 1
+        idf_sums[positions] += idfs[idx]
 
-    return r
+    return documents, scores, matched_terms, idf_sums
 
 
-def invert_pq_results(r: PriorityQueue()) -> list[(int, float)]:
+def taat(index_path: str, query: list[str], k: int, matching: str, ranker: str, inverted_lists: dict = None, segments = None) -> list[(int, float)]:
     """
-    Inverts the priority queue to return results in descending order
+    This function implements the TAAT algorithm, adding the scores of each term to an accumulator indexed by doc id
     """
-   
-    results = []
-    while not r.empty():
-        score, doc_id = r.get()
-        results.append((doc_id, score))
 
+    documents, scores, matched_terms, _ = accumulate_scores(index_path, query, [ranker], inverted_lists, segments)
+
+    if matching == "conjuntive_taat":
+        valid_positions = np.flatnonzero(matched_terms == len(query))
+    else:
+        valid_positions = np.flatnonzero(matched_terms)
 
-    return results[::-1]
 
+    return select_top_k(documents[valid_positions], scores[ranker][valid_positions], k, get_tie_keys(index_path, segments))
 
-def save_query_ans(output_path: str, query_idx: str, r: PriorityQueue) -> None:
+
+def extract_features(index_path: str, query: list[str], k: int, inverted_lists: dict = None, segments = None) -> list[tuple]:
     """
-    Saves the query results to a file
+    Scores the query with BM25 and TF-IDF under conjunctive and disjunctive matching in a single pass over its inverted lists,
+    returns a row for every document in any of the four top k with its four scores (zero when it is not in that top k),
+    its number of matched terms, its length and the summed idf of its matched terms, followed by its proximity features when the index has positions
     """
 
-    with open(output_path + query_idx, 'w') as f:       
-        for doc_id, score in invert_pq_results(r):
-            f.write(f"{query_idx},{doc_id},{score}\n")
-            
+    if not query:
+        return []
+
+    positional_index = get_positional_index(index_path, segments)
+    if positional_index is not None and inverted_lists is None:
+        # The positions of the candidates are found through the same inverted lists as their scores
+        inverted_lists = {term: get_inverted_list(index_path, term) for term in set(query)}
+
+    documents, scores, matched_terms, idf_sums = accumulate_scores(index_path, query, FEATURE_RANKERS, inverted_lists, segments)
+    doc_lens, _, _ = get_document_lengths(index_path, segments)
+
+    valid_positions = {"C": np.flatnonzero(matched_terms == len(query)), "D": np.flatnonzero(matched_terms)}
+    tie_keys = get_tie_keys(index_path, segments)
+
+    features = {}
+    for matching in FEATURE_MATCHINGS:
+        for ranker in FEATURE_RANKERS:
+            positions = valid_positions[matching]
+            for doc_id, score in select_top_k(documents[positions], scores[ranker][positions], k, tie_keys):
+                features.setdefault(doc_id, {})[f"{matching}_{ranker}"] = score
+
+    feature_documents = np.array(sorted(features), dtype=np.int64)
+    positions = np.searchsorted(documents, feature_documents)
+
+    # Rows in decreasing order of disjunctive BM25, ties broken by the highest doc id or corpus id
+    order = np.lexsort((feature_documents if tie_keys is None else tie_keys[feature_documents], scores["BM25"][positions]))[::-1]
+
+    rows = []
+    for doc_id, position in zip(feature_documents[order].tolist(), positions[order].tolist()):
+        rows.append((
+            doc_id,
+            *[features[doc_id].get(f"{matching}_{ranker}", 0) for ranker in FEATURE_RANKERS for matching in FEATURE_MATCHINGS],
+            matched_terms.item(position),
+            doc_lens.item(doc_id),
+            idf_sums.item(position)
+        ))
 
-def process_query(index_path: str, query: (str, [str]), doc_lens: dict[int, int], matching: str, ranker: str, cut: int, index_lock: Lock, lexicon_lock: Lock) -> None:
+    if positional_index is not None:
+        # Second stage: positions are only decoded for the best candidates of the first one
+        depth = min(len(rows), PROXIMITY_DEPTH)
+        positional_features = proximity_features(index_path, query, feature_documents[order][:depth], inverted_lists)
+        rows = [row + features for row, features in zip(rows, positional_features + [(0.0, 0)] * (len(rows) - depth))]
+
+    return rows
+
+
+def get_positional_index(index_path: str, segments = None):
+    """
+    Returns the positional index, None for indexes built without positions and for indexes with delta segments or deletions
+    """
+
+    return load_positional_index(index_path) if segments is None else None
+
+
+def get_feature_header(index_path: str) -> str:
     """
-    Process individual query
+    Returns the header of the features mode, with the positional features when the index has positions
+    """
+
+    if get_positional_index(*resolve_index(index_path)) is None:
+        return FEATURE_HEADER
+
+    return FEATURE_HEADER + "," + ",".join(POSITIONAL_FEATURES)
+
+
+def get_query_positions(index_path: str, query: list[str], doc_ids: np.ndarray, inverted_lists: dict = None) -> dict[str, dict[int, np.ndarray]]:
+    """
+    Returns the positions of every term of the query in each of the documents holding it, decoding only the blocks of positions of those documents,
+    index_path is a plain index as only those have positions
+    """
+
+    positional_index = get_positional_index(index_path)
+    lexicon = load_lexicon(index_path)
+
+    term_positions = {}
+    for term in set(query):
+        found_term, term_id, _, _, _ = lexicon.lookup(term)
+        if found_term is None:
+            term_positions[term] = {}
+            continue
+
+        term_doc_ids, freqs, _ = get_inverted_list(index_path, term, inverted_lists)
+        posting_idxs = np.minimum(np.searchsorted(term_doc_ids, doc_ids), len(term_doc_ids) - 1)
+        found = term_doc_ids[posting_idxs] == doc_ids
+
+        term_positions[term] = dict(zip(doc_ids[found].tolist(), positional_index.get_positions(term_id, freqs, posting_idxs[found])))
+
+    return term_positions
+
+
+def min_window(occurrences: list[np.ndarray]) -> int:
+    """
+    Returns the length in tokens of the smallest window holding a position of every term, given the positions of each term
+    """
+
+    positions = np.concatenate(occurrences)
+    terms = np.repeat(np.arange(len(occurrences)), [len(term_occurrences) for term_occurrences in occurrences])
+
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order].tolist(); terms = terms[order].tolist()
+
+    counts = [0] * len(occurrences)
+    covered_terms = 0; window = math.inf; left = 0
+    for right, term in enumerate(terms):
+        covered_terms += counts[term] == 0
+        counts[term] += 1
+
+        while covered_terms == len(occurrences):
+            window = min(window, positions[right] - positions[left] + 1)
+            counts[terms[left]] -= 1
+            covered_terms -= counts[terms[left]] == 0
+            left += 1
+
+    return window
+
+
+def phrase_matches(occurrences: list[np.ndarray]) -> int:
+    """
+    Counts the places where the terms show up one right after the other, given the positions of each term in phrase order
+    """
+
+    starts = occurrences[0]
+    for offset, positions in enumerate(occurrences[1:], 1):
+        starts = starts[np.isin(starts + offset, positions)]
+
+    return len(starts)
+
+
+def proximity_features(index_path: str, query: list[str], doc_ids: np.ndarray, inverted_lists: dict = None) -> list[(float, int)]:
+    """
+    Computes for each document the proximity of the query terms it holds, their number over the smallest window holding them all,
+    and the number of times it holds the query as a phrase, positions count the preprocessed tokens so stop words are skipped;
+    both are zero for documents holding less than two distinct query terms
+    """
+
+    term_positions = get_query_positions(index_path, query, doc_ids, inverted_lists)
+    distinct_terms = list(dict.fromkeys(query))
+
+    features = []
+    for doc_id in doc_ids.tolist():
+        occurrences = [term_positions[term][doc_id] for term in distinct_terms if doc_id in term_positions[term]]
+        if len(occurrences) < 2:
+            features.append((0.0, 0))
+            continue
+
+        proximity = len(occurrences) / min_window(occurrences)
+        phrases = phrase_matches([term_positions[term][doc_id] for term in query]) if len(occurrences) == len(distinct_terms) else 0
+
+        features.append((proximity, phrases))
+
+    return features
+
+
+def get_term_upper_bound(index_path: str, term: str, term_idf: float, ranker: str, inverted_lists: dict = None, segments = None) -> float:
+    """
+    Returns the highest score the term can give to any document, read from the lexicon when the index stores it
+    """
+
+    # The bounds in the lexicon of a segment were computed with the statistics of that segment alone
+    max_freq, max_bm25 = load_lexicon(index_path).lookup_upper_bounds(term) if segments is None else (None, None)
+
+    if max_freq is None:
+        # Indexes built without upper bounds in the lexicon, the whole list has to be decoded
+        doc_ids, freqs, tfc = get_inverted_list(index_path, term, inverted_lists, segments)
+        if len(doc_ids) == 0:
+            return 0.0
+
+        if ranker != 'BM25':
+            return tf_idf(int(freqs.max()), term_idf)
+
+        doc_lens, _, avg_doc_len = get_document_lengths(index_path, segments)
+        return float(bm25(term_idf, freqs, doc_lens[doc_ids], avg_doc_len).max())
+
+    return max_bm25 if ranker == 'BM25' else tf_idf(max_freq, term_idf)
+
+
+def get_block_upper_bound(term_idf: float, block_max_freq: int, term_upper_bound: float, ranker: str, avg_doc_len: float) -> float:
+    """
+    Returns the highest score the term can give to a document of a block, from the highest frequency of the block
+    """
+
+    if block_max_freq is None:
+        return term_upper_bound
+
+    # BM25 only grows with the frequency and is highest for an empty document
+    block_upper_bound = bm25(term_idf, block_max_freq, 0, avg_doc_len) if ranker == 'BM25' else tf_idf(block_max_freq, term_idf)
+
+    return min(term_upper_bound, block_upper_bound)
+
+
+def open_query_cursors(index_path: str, query: list[str], ranker: str, inverted_lists: dict = None, segments = None) -> (list[PostingCursor], list[float], list[float]):
+    """
+    Opens a cursor for each query term, with its idf and score upper bound
+    """
+
+    l = []
+    idfs = []
+    upper_bounds = []
+    _, number_of_documents, _ = get_document_lengths(index_path, segments)
+
+    for term in query:
+        cursor, tfc = get_posting_cursor(index_path, term, inverted_lists, segments)
+        l.append(cursor)
+        idfs.append(math.log10(number_of_documents/int(tfc)))
+        upper_bounds.append(get_term_upper_bound(index_path, term, idfs[-1], ranker, inverted_lists, segments))
+
+    return l, idfs, upper_bounds
+
+
+def wand(index_path: str, query: list[str], k: int, ranker: str, block_max: bool = False, inverted_lists: dict = None, segments = None) -> list[(int, float)]:
+    """
+    This function implements disjunctive retrieval with WAND, or Block-Max WAND when block_max is set,
+    returning the same documents as the disjunctive DAAT
+    """
+
+    r = TopK(k, get_tie_keys(index_path, segments))
+    doc_lens, _, avg_lens = get_document_lengths(index_path, segments)
+    l, idfs, upper_bounds = open_query_cursors(index_path, query, ranker, inverted_lists, segments)
+
+    # Until the selection is full every document is a candidate
+    threshold = r.threshold()
+    order = list(range(len(l)))
+
+    while True:
+        order.sort(key=lambda idx: l[idx].doc())
+
+        # The pivot is the first list whose upper bound, summed with the ones before it, can reach the threshold
+        pivot = None; summed_upper_bounds = 0
+        for position, idx in enumerate(order):
+            if l[idx].doc() == END_OF_LIST:
+                break
+
+            summed_upper_bounds += upper_bounds[idx]
+            if summed_upper_bounds * (1 + SCORE_SLACK) >= threshold:
+                pivot = position
+                break
+
+        if pivot is None:
+            break
+
+        pivot_doc = l[order[pivot]].doc()
+        while pivot + 1 < len(order) and l[order[pivot + 1]].doc() == pivot_doc:
+            pivot += 1
+
+        if block_max:
+            # Skips the pivot when the blocks it falls in cannot reach the threshold
+            summed_block_bounds = 0; next_doc = END_OF_LIST
+            for idx in order[:pivot + 1]:
+                block_last_id, block_max_freq = l[idx].block_bound(pivot_doc)
+                summed_block_bounds += get_block_upper_bound(idfs[idx], block_max_freq, upper_bounds[idx], ranker, avg_lens)
+                next_doc = min(next_doc, block_last_id + 1)
+
+            if summed_block_bounds * (1 + SCORE_SLACK) < threshold:
+                if pivot + 1 < len(order):
+                    next_doc = min(next_doc, l[order[pivot + 1]].doc())
+
+                for idx in order[:pivot + 1]:
+                    l[idx].advance(max(next_doc, pivot_doc + 1))
+                continue
+
+        if l[order[0]].doc() == pivot_doc:
+            sd = 0
+            doc_len = doc_lens.item(pivot_doc)
+            for idx, cursor in enumerate(l):
+                weight = cursor.freq() if cursor.doc() == pivot_doc else 0
+                current_score = bm25(idfs[idx], weight, doc_len, avg_lens) if ranker == 'BM25' else tf_idf(weight, idfs[idx])
+                sd += current_score
+
+            r.push(sd, pivot_doc)
+            threshold = r.threshold()
+
+            for idx in order[:pivot + 1]:
+                l[idx].next()
+
+        else:
+            # No document before the pivot can reach the threshold
+            for idx in order[:pivot]:
+                l[idx].advance(pivot_doc)
+
+
+    return r.results()
+
+
+def maxscore(index_path: str, query: list[str], k: int, ranker: str, inverted_lists: dict = None, segments = None) -> list[(int, float)]:
+    """
+    This function implements disjunctive retrieval with MaxScore, returning the same documents as the disjunctive DAAT
+    """
+
+    r = TopK(k, get_tie_keys(index_path, segments))
+    doc_lens, _, avg_lens = get_document_lengths(index_path, segments)
+    l, idfs, upper_bounds = open_query_cursors(index_path, query, ranker, inverted_lists, segments)
+
+    def term_score(idx: int, weight: int, doc_id: int) -> float:
+        return bm25(idfs[idx], weight, doc_lens.item(doc_id), avg_lens) if ranker == 'BM25' else tf_idf(weight, idfs[idx])
+
+    # Lists sorted by upper bound, the ones whose summed upper bounds cannot reach the threshold are non essential
+    order = sorted(range(len(l)), key=lambda idx: upper_bounds[idx])
+    summed_upper_bounds = []
+    for idx in order:
+        summed_upper_bounds.append(upper_bounds[idx] + (summed_upper_bounds[-1] if summed_upper_bounds else 0))
+
+    threshold = r.threshold()
+    first_essential = 0
+
+    doc_id = min((l[idx].doc() for idx in order), default=END_OF_LIST)
+    while doc_id != END_OF_LIST:
+
+        # Essential lists are walked document by document
+        partial_score = 0
+        for idx in order[first_essential:]:
+            if l[idx].doc() == doc_id:
+                partial_score += term_score(idx, l[idx].freq(), doc_id)
+
+        # Non essential lists are only probed while the document can still reach the threshold
+        pruned = False
+        for position in range(first_essential - 1, -1, -1):
+            if (partial_score + summed_upper_bounds[position]) * (1 + SCORE_SLACK) < threshold:
+                pruned = True
+                break
+
+            idx = order[position]
+            if l[idx].advance(doc_id) == doc_id:
+                partial_score += term_score(idx, l[idx].freq(), doc_id)
+
+        if not pruned and partial_score * (1 + SCORE_SLACK) >= threshold:
+            # The final score is summed in query order, as in the DAAT
+            sd = 0
+            for idx, cursor in enumerate(l):
+                weight = cursor.freq() if cursor.doc() == doc_id else 0
+                sd += term_score(idx, weight, doc_id)
+
+            r.push(sd, doc_id)
+
+            if r.is_full():
+                threshold = r.threshold()
+                while first_essential < len(order) and summed_upper_bounds[first_essential] * (1 + SCORE_SLACK) < threshold:
+                    first_essential += 1
+
+        for idx in order[first_essential:]:
+            if l[idx].doc() == doc_id:
+                l[idx].next()
+
+        doc_id = min((l[idx].doc() for idx in order[first_essential:]), default=END_OF_LIST)
+
+
+    return r.results()
+
+
+_impact_offsets = {}
+
+def load_impact_offsets(index_path: str) -> np.ndarray:
+    """
+    Returns the offsets of the impact ordered lists, mapping them only once per worker
+    """
+
+    if index_path not in _impact_offsets:
+        _impact_offsets[index_path] = np.memmap(os.path.join(index_path, 'impact_offsets'), dtype=">u8", mode='r')
+
+    return _impact_offsets[index_path]
+
+
+def check_impact_index(index_path: str, metadata: dict) -> None:
+    """
+    Raises a ValueError when the index has no impact index or when its impact index was built for other documents or terms
+    """
+
+    if "impact_scale" not in metadata or not os.path.isfile(os.path.join(index_path, 'impact_offsets')):
+        raise ValueError(f"The index in {index_path} was built without impact scores")
+
+    # Indexes built before the impacts recorded their number of documents are only checked against the lexicon
+    _, number_of_documents, _ = get_document_lengths(index_path)
+    same_documents = metadata.get("impact_number_of_documents", number_of_documents) == number_of_documents
+    same_terms = len(load_impact_offsets(index_path)) == len(load_lexicon(index_path)) + 1
+
+    if not same_documents or not same_terms:
+        raise ValueError(f"The impact index in {index_path} was built for another version of the index, it has to be rebuilt")
+
+
+def get_impact_list(index_path: str, term: str) -> bytes:
+    """
+    Returns the encoded impact ordered list of a given term, empty when the term is not in the lexicon
+    """
+
+    term, term_id, byte_start, byte_end, tfc = load_lexicon(index_path).lookup(term)
+    if (term == None):
+        return b""
+
+    byte_offsets = load_impact_offsets(index_path)
+    return retrieve_word_bytes(os.path.join(index_path, 'impact_index'), int(byte_offsets[term_id]), int(byte_offsets[term_id + 1]))
+
+
+def saat(index_path: str, query: list[str], k: int, postings_budget: int = None) -> list[(int, float)]:
+    """
+    This function implements score at a time retrieval over the quantized BM25 impacts, segments of all the query terms
+    are summed from the highest impact down, stopping early once postings_budget postings were processed
+    """
+
+    metadata = load_index_metadata(index_path)
+    check_impact_index(index_path, metadata)
+
+    l = []
+    for term in query:
+        l.append(read_impact_segments(get_impact_list(index_path, term)))
+
+    # Segments of every term, from the highest impact to the lowest
+    segment_order = sorted(
+        ((int(impact), idx, segment_idx) for idx, (segments, _) in enumerate(l) for segment_idx, impact in enumerate(segments["impact"])),
+        key=lambda segment: -segment[0]
+    )
+
+    accumulator = np.zeros(len(get_document_lengths(index_path)[0]), dtype=np.int64)
+    touched_documents = []
+    processed_postings = 0
+
+    for impact, idx, segment_idx in segment_order:
+        if postings_budget is not None and processed_postings >= postings_budget:
+            break
+
+        segments, encoded_segments = l[idx]
+        doc_ids = decode_impact_segment(segments, encoded_segments, segment_idx)
+
+        accumulator[doc_ids] += impact
+        touched_documents.append(doc_ids)
+        processed_postings += len(doc_ids)
+
+    candidates = np.unique(np.concatenate(touched_documents)) if touched_documents else np.empty(0, dtype=np.int64)
+
+
+    return select_top_k(candidates, accumulator[candidates] * metadata["impact_scale"], k, get_tie_keys(index_path))
+
+
+def rank_query(index_path: str, query: list[str], matching: str, ranker: str, cut: int, postings_budget: int = None, inverted_lists: dict = None, resolved_index: tuple = None) -> list[(int, float)]:
+    """
+    Ranks the documents for a preprocessed query with the given matching strategy,
+    the features matching returns the rows of extract_features instead, documents are given by their corpus id;
+    resolved_index is the index path and the segments a batch of queries was resolved to, with the inverted lists it fetched
+    """
+
+    # Queries made only of stop words or of terms preprocessed away match no document
+    if not query:
+        return []
+
+    # Every step of the query reads the same generation of the segments, an update committed meanwhile is seen by the next query
+    if resolved_index is None:
+        refresh_segments(index_path)
+        resolved_index = resolve_index(index_path)
+
+    index_path, segments = resolved_index
+    if segments is not None and segments.number_of_documents == 0:
+        return []
+
+    if matching == "features":
+        results = extract_features(index_path, query, cut, inverted_lists, segments)
+    elif matching in ("wand", "bmw"):
+        results = wand(index_path, query, cut, ranker, block_max = matching == "bmw", inverted_lists = inverted_lists, segments = segments)
+    elif matching == "maxscore":
+        results = maxscore(index_path, query, cut, ranker, inverted_lists, segments)
+    elif matching == "saat":
+        if ranker != 'BM25':
+            raise ValueError("Impact scores are only stored for BM25")
+        if segments is not None:
+            raise ValueError("Impact scores are only stored for compacted indexes without deletions")
+        results = saat(index_path, query, cut, postings_budget)
+    elif matching in ("conjuntive_taat", "disjunctive_taat"):
+        results = taat(index_path, query, cut, matching, ranker, inverted_lists, segments)
+    else:
+        results = daat(index_path, query, cut, matching, ranker, inverted_lists, segments)
+
+    document_ids = load_document_ids(index_path) if segments is None else (segments.corpus_ids,)
+    if document_ids is None:
+        return results
+
+    # The rankers work on the dense doc ids of the postings
+    corpus_ids = document_ids[0]
+    return [(corpus_ids.item(row[0]),) + tuple(row[1:]) for row in results]
+
+
+def process_query(index_path: str, query: (str, [str]), matching: str, ranker: str, cut: int, postings_budget: int = None) -> (list[(str, list[(int, float)])], dict):
+    """
+    Process individual query, returns its results with the posting cache counters of the worker
     """
     query_idx = query[0]
     query = query[1]
 
     
-    r = daat(index_path, query, doc_lens, cut, matching, ranker, index_lock, lexicon_lock)
-    save_query_ans(f"results/{ranker}_output/", query_idx, r)
+    r = rank_query(index_path, query, matching, ranker, cut, postings_budget)
+
+    return [(query_idx, r)], get_posting_cache().stats()
+
+
+def process_query_batch(index_path: str, queries: list[(str, [str])], matching: str, ranker: str, cut: int, postings_budget: int = None) -> (list[(str, list[(int, float)])], dict):
+    """
+    Process a batch of queries, reading the inverted list of each distinct term once for the whole batch,
+    returns the results of every query with the posting cache counters of the worker
+    """
+
+    # The whole batch reads the generation of the segments its inverted lists are fetched from
+    refresh_segments(index_path)
+    resolved_index = resolve_index(index_path)
+
+    # The impact ordered lists of the SAAT are read per query
+    inverted_lists = fetch_inverted_lists(resolved_index[0], [query for _, query in queries], resolved_index[1]) if matching != "saat" else None
+
+    answers = []
+    for query_idx, query in queries:
+        answers.append((query_idx, rank_query(index_path, query, matching, ranker, cut, postings_budget, inverted_lists, resolved_index)))
+
+    return answers, get_posting_cache().stats()
@@ -0,0 +1,239 @@
+import os, json, time, logging, shutil
+
+import numpy as np
+
+from multiprocessing import Pool
+from lexicon import load_lexicon
+from index_metadata import load_index_metadata, save_index_metadata
+from document_ids import to_doc_ids
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Term ids of the lexicon, the tokens of a document are kept in their order in the text
+TOKEN_DTYPE = np.dtype(">u4")
+
+# Byte range of the block of every document in the store and the position of its tokens in the block, indexed by dense doc id
+DOCUMENT_OFFSET_DTYPE = np.dtype([("block_start", ">u8"), ("block_end", ">u8"), ("token_start", ">u4"), ("token_count", ">u4")])
+
+# Block start of the ids without a document
+MISSING_DOCUMENT = np.iinfo(np.uint64).max
+
+# Documents stored in the same block, a block is compressed as a whole
+DOCUMENT_BLOCK_SIZE = 64
+
+COMPRESSIONS = ("none", "zstd")
+ZSTD_LEVEL = 3
+
+
+def check_compression(compression: str) -> None:
+    """
+    Raises a ValueError when the compression of the document store is unknown or its module is not installed
+    """
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown document store compression {compression}, expected one of {', '.join(COMPRESSIONS)}")
+
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("The zstd compression of the document store needs the zstandard module, install it with 'pip3 install zstandard' (see requirements.txt)")
+
+
+def read_term_ids(index_path: str) -> dict[str, int]:
+    """
+    Reads the id of every term of the lexicon
+    """
+
+    with open(index_path + "term_lexicon.txt", 'r') as lexicon:
+        return {line.split(" ", 1)[0]: term_id for term_id, line in enumerate(lexicon)}
+
+
+def encode_document_partition(index_path: str, file_name: str, compression: str, block_size: int) -> np.ndarray:
+    """
+    Encodes the doc index of a partition to blocks of token ids, returns the corpus id and the offsets in the partition of every document
+    """
+
+    term_ids = read_term_ids(index_path)
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if compression == "zstd" else None
+
+    with open(index_path + "doc_indexes/" + file_name, 'r') as f:
+        documents = [json.loads(line) for line in f]
+
+    records = np.empty(len(documents), dtype=[("corpus_id", np.int64)] + DOCUMENT_OFFSET_DTYPE.descr)
+    byte_offset = 0
+
+    with open(index_path + "doc_store/" + file_name, 'wb') as output_file:
+        for block_start in range(0, len(documents), block_size):
+            tokens = []
+            for idx in range(block_start, min(block_start + block_size, len(documents))):
+                words = documents[idx]["text"].split()
+                records[idx] = (int(documents[idx]["id"]), byte_offset, 0, len(tokens), len(words))
+                tokens.extend(term_ids[word] for word in words)
+
+            block = np.array(tokens, dtype=TOKEN_DTYPE).tobytes()
+            if compressor is not None:
+                block = compressor.compress(block)
+
+            output_file.write(block)
+            byte_offset += len(block)
+            records["block_end"][block_start:block_start + block_size] = byte_offset
+
+    return records
+
+
+def build_document_store(index_path: str, number_of_threads: int, corpus_ids: np.ndarray, compression: str = "none", block_size: int = DOCUMENT_BLOCK_SIZE) -> None:
+    """
+    Builds the document store from the doc indexes of the partitions, once the lexicon gives the term ids,
+    the offset table is indexed by the dense doc ids given to corpus_ids
+    """
+
+    seconds = time.time()
+    check_compression(compression)
+
+    if not os.path.isdir(index_path + "doc_store/"):
+        os.mkdir(index_path + "doc_store/")
+
+    file_names = sorted(os.listdir(index_path + "doc_indexes/"))
+    with Pool(max(min(number_of_threads, len(file_names)), 1)) as pool:
+        partition_records = pool.starmap(encode_document_partition, [(index_path, file_name, compression, block_size) for file_name in file_names])
+
+    offsets = np.zeros(len(corpus_ids), dtype=DOCUMENT_OFFSET_DTYPE)
+    offsets["block_start"] = MISSING_DOCUMENT
+
+    byte_offset = 0
+    with open(index_path + "document_store", 'wb') as output_file:
+        for file_name, records in zip(file_names, partition_records):
+            with open(index_path + "doc_store/" + file_name, 'rb') as f:
+                shutil.copyfileobj(f, output_file)
+
+            doc_ids = to_doc_ids(corpus_ids, records["corpus_id"])
+            offsets["block_start"][doc_ids] = records["block_start"] + byte_offset
+            offsets["block_end"][doc_ids] = records["block_end"] + byte_offset
+            offsets["token_start"][doc_ids] = records["token_start"]
+            offsets["token_count"][doc_ids] = records["token_count"]
+
+            byte_offset += os.path.getsize(index_path + "doc_store/" + file_name)
+
+    offsets.tofile(index_path + "document_offsets")
+    shutil.rmtree(index_path + "doc_store/")
+
+    save_index_metadata(index_path, {"document_store_compression": compression, "document_store_block_size": block_size})
+
+    logging.info(f"Time to build the document store: {time.time() - seconds} seconds")
+
+
+class DocumentStore:
+    """
+    Token ids of every document mapped into memory, any document is read through the offset table without loading the others
+    """
+
+    def __init__(self, index_path: str):
+
+        self.lexicon = load_lexicon(index_path)
+        self.compression = load_index_metadata(index_path).get("document_store_compression", "none")
+        check_compression(self.compression)
+
+        self.offsets = self.map_file(os.path.join(index_path, "document_offsets"), DOCUMENT_OFFSET_DTYPE)
+        self.store = self.map_file(os.path.join(index_path, "document_store"), np.uint8)
+
+
+    @staticmethod
+    def map_file(file_path: str, dtype) -> np.ndarray:
+        if os.path.getsize(file_path) == 0:
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(file_path, dtype=dtype, mode='r')
+
+
+    def __contains__(self, doc_id: int) -> bool:
+        return 0 <= doc_id < len(self.offsets) and self.offsets[doc_id]["block_start"] != MISSING_DOCUMENT
+
+
+    def read_block(self, block_start: int, block_end: int) -> np.ndarray:
+        """
+        Returns the token ids of a block, decompressing it when the store is compressed
+        """
+
+        block = self.store[block_start:block_end].tobytes()
+        if self.compression == "zstd":
+            # Decompressors can not be shared by the threads of the server
+            block = zstandard.ZstdDecompressor().decompress(block)
+
+        return np.frombuffer(block, dtype=TOKEN_DTYPE)
+
+
+    def get_token_ids(self, doc_id: int) -> np.ndarray:
+        """
+        Returns the term ids of the tokens of a document, None when there is no document with that id
+        """
+
+        if doc_id not in self:
+            return None
+
+        block_start, block_end, token_start, token_count = self.offsets[doc_id].tolist()
+
+        return self.read_block(block_start, block_end)[token_start:token_start + token_count]
+
+
+    def get_terms(self, doc_id: int) -> list[str]:
+        """
+        Returns the preprocessed tokens of a document, None when there is no document with that id
+        """
+
+        token_ids = self.get_token_ids(doc_id)
+        if token_ids is None:
+            return None
+
+        return [self.lexicon.get_line(term_id)[0].decode("utf-8") for term_id in token_ids.tolist()]
+
+
+    def iter_token_ids(self, first_doc: int, end_doc: int):
+        """
+        Yields the id and the term ids of the tokens of every document in a range of doc ids, in doc id order,
+        decoding a block once for the documents next to each other in it
+        """
+
+        block = None; current_block = None
+        for doc_id in range(first_doc, end_doc):
+            if doc_id not in self:
+                continue
+
+            block_start, block_end, token_start, token_count = self.offsets[doc_id].tolist()
+            if current_block != block_start:
+                block = self.read_block(block_start, block_end)
+                current_block = block_start
+
+            yield doc_id, block[token_start:token_start + token_count]
+
+
+    def iter_documents(self):
+        """
+        Yields the id and the preprocessed tokens of every document, decoding every block once
+        """
+
+        doc_ids = np.flatnonzero(self.offsets["block_start"] != MISSING_DOCUMENT)
+        doc_ids = doc_ids[np.argsort(self.offsets["block_start"][doc_ids], kind="stable")]
+
+        block = None; current_block = None
+        for doc_id in doc_ids.tolist():
+            block_start, block_end, token_start, token_count = self.offsets[doc_id].tolist()
+            if current_block != block_start:
+                block = self.read_block(block_start, block_end)
+                current_block = block_start
+
+            yield doc_id, [self.lexicon.get_line(term_id)[0].decode("utf-8") for term_id in block[token_start:token_start + token_count].tolist()]
+
+
+_document_stores = {}
+
+def load_document_store(index_path: str) -> DocumentStore:
+    """
+    Returns the document store of the index, mapping it only once per worker
+    """
+
+    if index_path not in _document_stores:
+        _document_stores[index_path] = DocumentStore(index_path)
+
+    return _document_stores[index_path]
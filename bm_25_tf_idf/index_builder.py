@@ -1,113 +1,199 @@
-import json, os, time, logging, math, subprocess
+import json, os, time, logging, math, gc, psutil
 
-from preprocesser import preprocesser, get_word_frequency
-from collections import OrderedDict
-from multiprocessing import  Pool
+import numpy as np
 
+from array import array
+from itertools import islice
+from preprocesser import preprocess_many, get_word_frequency, get_document_text, read_partition
+from index_runs import write_run, DOC_LEN_RECORD_DTYPE
+from build_manifest import load_build_manifest, save_build_manifest
+from parsed_corpus import read_parsed_documents
+from multiprocessing import  Pool
 
-def encode_to_string(word: int, doc_freqs: list[int, int]) -> str:
-    """
-    Encodes a word and its document frequencies to a string
-    """
+# Documents preprocessed together, the memory of the worker is checked after each batch
+MEMORY_CHECK_INTERVAL = 1000
 
-    line = "{\"word\":\"" + str(word) + "\",\"docs\": ["
-    for doc, freq in doc_freqs:
-        line += "{\"id\":\"" + str(doc) + "\",\"freq\":\"" + str(freq) + "\"},"
-    line = line[:-1]
-    line += "]}\n" 
+# Flushing a run takes about this many times the memory of its postings, for the sorting and the binary records
+FLUSH_MEMORY_FACTOR = 6
 
-    return line
+# Rough memory taken by a new term of the term dictionary and by a document of the doc index, besides their data
+TERM_OVERHEAD_BYTES = 150
+DOC_OVERHEAD_BYTES = 100
 
 
-def download_inverted_index(index: OrderedDict, index_path: str, file_name: str):
+def download_inverted_index(term_ids: dict[str, int], postings: array, index_path: str, run_name: str):
     """
-    Downloads the index of a shard to a file
+    Downloads the in memory index of a partition to a sorted binary run
     """
 
     seconds = time.time()
-    with open(index_path + "inverted_indexes/" + file_name, 'w') as fp:
-        for word in sorted(index):
 
-            # line = encode_to_binary(word, index[word])
-            line = encode_to_string(word, index[word])
-            fp.write(line)
+    terms = sorted(term_ids)
+    # The run numbers its terms in sorted order
+    run_term_ids = np.empty(len(terms), dtype=np.int64)
+    run_term_ids[[term_ids[word] for word in terms]] = np.arange(len(terms))
+
+    postings = np.frombuffer(postings, dtype=np.uint32).reshape(-1, 3)
+    posting_term_ids = run_term_ids[postings[:, 0]]
+
+    # Postings of each term sorted by doc id
+    order = np.lexsort((postings[:, 1], posting_term_ids))
+    write_run(index_path + "runs/" + run_name, terms, posting_term_ids[order], postings[order, 1], postings[order, 2])
 
-    logging.info(f"Time to save inverted index of shard {file_name}: {time.time() - seconds} seconds")
+    logging.info(f"Time to save inverted index of run {run_name}: {time.time() - seconds} seconds")
 
 
-def download_doc_index(index: OrderedDict, index_path: str, file_name: str):
+def download_doc_index(index: dict, index_path: str, file_name: str):
     """
-    Downloads the doc index of a shard to a file
+    Appends the doc index and the document lengths of a partition to its files
     """
 
     seconds = time.time()
-    with open(index_path + "doc_indexes/" + file_name, 'w') as dindex, open(index_path + "doc_lens/" + file_name, 'w') as dstats:
-        for doc in sorted(index):
-            index[doc] = " ".join(index[doc])
+
+    doc_lens = np.empty(len(index), dtype=DOC_LEN_RECORD_DTYPE)
+    with open(index_path + "doc_indexes/" + file_name, 'a') as dindex:
+        for idx, doc in enumerate(sorted(index)):
             dindex.write(json.dumps({"id": doc, "text": index[doc]}) + "\n")
-            dstats.write(json.dumps({"id": doc, "len": len(index[doc])}) + "\n")
-            
+            doc_lens[idx] = (int(doc), len(index[doc]))
+
+    with open(index_path + "doc_lens/" + file_name, 'ab') as dstats:
+        doc_lens.tofile(dstats)
+
+    logging.info(f"Time to save doc index of partition {file_name}: {time.time() - seconds} seconds")
 
-        # json.dump(index, fp)
 
+def read_cleaned_documents(corpus_path: str, start: int, end: int, parsed: bool):
+    """
+    Yields batches of the ids and the preprocessed text of the documents of a partition, either a byte range of the corpus
+    or a range of the documents of a parsed corpus
+    """
 
+    if parsed:
+        yield from read_parsed_documents(corpus_path, start, end, MEMORY_CHECK_INTERVAL)
+        return
 
-    logging.info(f"Time to save doc index of shard {file_name}: {time.time() - seconds} seconds")
+    documents = read_partition(corpus_path, start, end)
+    while batch := list(islice(documents, MEMORY_CHECK_INTERVAL)):
+        yield [(doc['id'], cleaned_text) for doc, cleaned_text in zip(batch, preprocess_many([get_document_text(doc) for doc in batch]))]
 
 
-def index_shard(file_name: str, index_path: str) -> None:
+def index_partition(corpus_path: str, index_path: str, partition_idx: int, start: int, end: int, memory_share: int, parsed: bool = False) -> None:
     """
-    Indexes a shard of the corpus
+    Indexes a partition of the corpus in a single pass, flushing the postings to a new sorted run
+    whenever the worker gets close to its share of the memory budget
     """
 
     seconds = time.time()
-    inverted_index = OrderedDict()
-    doc_index = OrderedDict()
-    
-    with open(index_path + "shards/" + file_name, 'r') as f:
-        
-        for line in f:
-            doc = json.loads(line, strict=False)
-            text_to_be_processed = doc['text'] + " " +  doc["title"] + " "+ " ".join(doc['keywords'])
-            cleaned_text = preprocesser(text_to_be_processed)
-            doc_index[doc['id']] = cleaned_text
+    file_name = f"{partition_idx:04d}"
+    # Term dictionary of the partition, terms get dense ids as they show up
+    term_ids = {}
+    # Term id, doc id and frequency of every posting
+    postings = array('I')
+    doc_index = {}
+    number_of_runs = 0
+
+    process = psutil.Process()
+    # Memory the in memory index can take, besides what the worker already uses
+    index_budget = max(memory_share - process.memory_info().rss, 0)
+    index_bytes = 0
+
+    # Runs append to the doc index of the partition
+    open(index_path + "doc_indexes/" + file_name, 'w').close()
+    open(index_path + "doc_lens/" + file_name, 'wb').close()
+
+    def flush():
+        nonlocal term_ids, postings, doc_index, number_of_runs, index_bytes
+
+        download_inverted_index(term_ids, postings, index_path, f"{file_name}_{number_of_runs:04d}")
+        download_doc_index(doc_index, index_path, file_name)
+
+        term_ids = {}; postings = array('I'); doc_index = {}
+        number_of_runs += 1; index_bytes = 0
+        gc.collect()
+
+    for batch in read_cleaned_documents(corpus_path, start, end, parsed):
+        for doc_id, cleaned_text in batch:
+            doc_index[doc_id] = " ".join(cleaned_text)
+            index_bytes += len(doc_index[doc_id]) + DOC_OVERHEAD_BYTES
+
             word_freq = get_word_frequency(cleaned_text)
-            
-            for word, freq in word_freq.items():	
-                if word not in inverted_index:
-                    inverted_index[word] = []
-                inverted_index[word].append((doc['id'],freq))
+            for word, freq in word_freq.items():
+                term_id = term_ids.get(word)
+                if term_id is None:
+                    term_id = term_ids[word] = len(term_ids)
+                    index_bytes += TERM_OVERHEAD_BYTES
+                postings.extend((term_id, int(doc_id), freq))
 
+            index_bytes += 3 * postings.itemsize * len(word_freq)
 
-    logging.info(f"Time to create index of shard {file_name}: {time.time() - seconds} seconds")
-   
-    download_inverted_index(inverted_index, index_path, file_name)
-    download_doc_index(doc_index, index_path, file_name)
+        # Freed memory is kept by the allocator, so the resident size alone only triggers a flush once the index is large enough to matter
+        over_budget = index_bytes * FLUSH_MEMORY_FACTOR >= index_budget
+        over_share = process.memory_info().rss >= memory_share and index_bytes * FLUSH_MEMORY_FACTOR * 4 >= index_budget
+        if over_budget or over_share:
+            logging.info(f"Partition {file_name} flushing run {number_of_runs} at {process.memory_info().rss // (1024 * 1024)} MB")
+            flush()
 
 
-def run_indexer_thread_pool(index_path: str, number_of_threads: int, number_of_shards: int):
+    logging.info(f"Time to create index of partition {file_name}: {time.time() - seconds} seconds")
+
+    if postings or doc_index or number_of_runs == 0:
+        flush()
+
+
+def index_partition_task(task: tuple) -> (int, Exception):
+    """
+    Indexes a partition, returning its error instead of raising it so that the other partitions are still recorded as indexed
+    """
+
+    try:
+        index_partition(*task)
+    except Exception as error:
+        return task[2], error
+
+    return task[2], None
+
+
+def run_indexer_thread_pool(corpus_path: str, index_path: str, number_of_threads: int, partitions: list[(int, int)], memory_limit: int, parsed: bool = False):
     """
-    Creates a thread pool with the number of threads we want to use
+    Creates a thread pool with the number of threads we want to use, each worker gets an even share of the memory limit (MB),
+    corpus_path is a parsed corpus when parsed is set; partitions indexed by an interrupted build are not indexed again
     """
-    
-    notice_files = os.listdir(index_path + "shards/")
-    count = 0
-    while len(notice_files) < number_of_shards:
-        notice_files = os.listdir(index_path + "shards/")
-        time.sleep(1)
-        count += 1
 
-            
-    logging.info(f"Found {len(notice_files)} shards")
+    memory_share = memory_limit * 1024 * 1024 // number_of_threads
+
+    for folder in ("runs/", "doc_indexes/", "doc_lens/"):
+        if not os.path.isdir(index_path + folder):
+            os.mkdir(index_path + folder)
+
+    manifest = load_build_manifest(index_path)
+    if manifest["partitions"] is None:
+        manifest["partitions"] = [list(partition) for partition in partitions]
+        save_build_manifest(index_path, manifest)
+
+    # A resumed build keeps the partitions it started with, whatever the number of threads
+    partitions = manifest["partitions"]
+    pending = [partition_idx for partition_idx in range(len(partitions)) if partition_idx not in manifest["completed_partitions"]]
 
-    if not os.path.isdir(index_path + "inverted_indexes/"):
-        os.mkdir(index_path + "inverted_indexes/") 
+    # Run files of a partition that was interrupted, it is indexed again from its start
+    for file_name in os.listdir(index_path + "runs/"):
+        if int(file_name.split("_")[0]) in pending:
+            os.remove(index_path + "runs/" + file_name)
 
-    if not os.path.isdir(index_path + "doc_indexes/"):
-        os.mkdir(index_path + "doc_indexes/") 
+    if not pending:
+        return
 
-    if not os.path.isdir(index_path + "doc_lens/"):
-        os.mkdir(index_path + "doc_lens/") 
+    logging.info(f"Indexing {len(pending)} of {len(partitions)} partitions")
 
+    tasks = [(corpus_path, index_path, partition_idx, partitions[partition_idx][0], partitions[partition_idx][1], memory_share, parsed) for partition_idx in pending]
+    errors = []
     with Pool(number_of_threads) as pool:
-        pool.starmap(index_shard, [(file_name, index_path) for file_name in notice_files])
\ No newline at end of file
+        for partition_idx, error in pool.imap_unordered(index_partition_task, tasks):
+            if error is not None:
+                logging.info(f"Partition {partition_idx:04d} failed: {error!r}")
+                errors.append(error)
+            else:
+                manifest["completed_partitions"].append(partition_idx)
+                save_build_manifest(index_path, manifest)
+
+    if errors:
+        raise errors[0]
@@ -1,30 +1,60 @@
 
-import json, os, time, logging, math, subprocess
+import json, os, time, logging, math, shutil, heapq
+
+import numpy as np
 
-from collections import OrderedDict
 from multiprocessing import Pool
+from postings import encode_postings, decode_postings, encode_impact_postings, BLOCK_SIZE, FORMAT_VERSION, IMPACT_SEGMENT_DTYPE
+from index_metadata import save_index_metadata, read_index_metadata
+from document_lengths import save_doc_lens
+from document_store import build_document_store
+from positional_index import build_positional_index, remove_positional_index
+from document_ids import assign_doc_ids, to_doc_ids, save_document_ids
+from index_runs import RunCursor, read_run_terms, list_runs, DOC_LEN_RECORD_DTYPE
+from build_manifest import load_build_manifest, save_build_manifest, complete_stage, finish_build, BUILD_FOLDERS
+from document_matching import bm25
 
 logging.basicConfig(filename='main.log', level=logging.INFO)
 
+# Impacts are stored in the unsigned impact field of the segments of the impact ordered lists
+MAX_IMPACT_BITS = 8 * IMPACT_SEGMENT_DTYPE["impact"].itemsize
+
 
 
-def encode_to_binary(word_id: int, docs: list[int, int]) -> bytearray:
+def encode_to_binary(word_id: int, doc_ids: np.ndarray, freqs: np.ndarray, format_version: int) -> (bytes, int):
     """Encodes a word and its document frequencies to binary"""
     
-    bin_array = bytearray()
-    bin_array += word_id.to_bytes(4, "big")
-    bin_array += len(docs).to_bytes(4, "big")
-
-    for doc in docs:
-        try:
-            bin_array += int(doc["id"]).to_bytes(4, "big")
-            bin_array += int(doc["freq"]).to_bytes(2, "big")
-        except TypeError:
-            print(f"Error encoding {word_id, doc} to binary")
+    bin_array = encode_postings(word_id, doc_ids, freqs, format_version)
 
     return bin_array, len(bin_array)
 
 
+def load_collection_statistics(index_path: str, doc_order: str = "id", corpus_path: str = None) -> dict:
+    """Gives every document of all partitions a dense doc id, returns their corpus ids and their lengths indexed by doc id, with the collection size and average length"""
+
+    records = [np.fromfile(index_path + "doc_lens/" + file_name, dtype=DOC_LEN_RECORD_DTYPE) for file_name in sorted(os.listdir(index_path + "doc_lens/"))]
+    records = np.concatenate(records) if records else np.empty(0, dtype=DOC_LEN_RECORD_DTYPE)
+
+    ids = records["doc_id"].astype(np.int64); lens = records["len"].astype(np.int64)
+
+    corpus_ids = assign_doc_ids(ids, doc_order, corpus_path)
+    corpus_id_sorter = np.argsort(corpus_ids, kind="stable")
+
+    doc_lens = np.zeros(len(corpus_ids), dtype=np.int64)
+    doc_lens[to_doc_ids(corpus_ids, ids, corpus_id_sorter)] = lens
+
+    return {"doc_lens": doc_lens, "number_of_documents": len(ids), "avg_doc_len": int(lens.sum())/len(ids), "corpus_ids": corpus_ids, "corpus_id_sorter": corpus_id_sorter}
+
+
+def term_upper_bounds(doc_ids: np.ndarray, freqs: np.ndarray, collection_stats: dict) -> (int, float):
+    """Computes the highest frequency and the highest BM25 score of a word in any document"""
+
+    idf = math.log10(collection_stats["number_of_documents"]/len(doc_ids))
+    scores = bm25(idf, freqs, collection_stats["doc_lens"][doc_ids], collection_stats["avg_doc_len"])
+
+    return int(freqs.max()), float(scores.max())
+
+
 def save_index_statistics(number_of_words: int, summed_n_docs: int, index_path: str):
     """Saves the index statistics to a file"""
 
@@ -37,186 +67,304 @@ def save_index_statistics(number_of_words: int, summed_n_docs: int, index_path:
         json.dump(stats, fp)
 
 
-def builds_term_lexicon(word: str, lexicon, number_of_words: int, number_of_postings: int, byte_start: int, byte_end: int) -> int:
+def builds_term_lexicon(word: str, lexicon, number_of_words: int, number_of_postings: int, byte_start: int, byte_end: int, max_freq: int, max_bm25: float) -> int:
     """
     Builds the term lexicon
     """
     
-    lexicon.write(word + " " + str(number_of_words) + " " + str(byte_start) + " " + str(byte_end) + " " + str(number_of_postings) + "\n")
+    lexicon.write(word + " " + str(number_of_words) + " " + str(byte_start) + " " + str(byte_end) + " " + str(number_of_postings) + " " + str(max_freq) + " " + repr(max_bm25) + "\n")
     number_of_words += 1
     
     return number_of_words
 
 
-def builds_last_index(output_file, doc: list, lexicon, number_of_words: int, summed_n_docs: int, byte_offset: int) -> (int, int, int):
+def builds_last_index(output_file, word: str, doc_ids: np.ndarray, freqs: np.ndarray, lexicon, number_of_words: int, summed_n_docs: int, byte_offset: int, format_version: int, collection_stats: dict) -> (int, int, int):
     """
     Builds the last index
     """
     
-    bin_array, doc_len = encode_to_binary(number_of_words, doc["docs"])
+    bin_array, doc_len = encode_to_binary(number_of_words, doc_ids, freqs, format_version)
     output_file.write(bin_array)                                      
+
+    max_freq, max_bm25 = term_upper_bounds(doc_ids, freqs, collection_stats)
     
-    number_of_postings = len(doc["docs"])
+    number_of_postings = len(doc_ids)
 
     summed_n_docs += number_of_postings
 
     number_of_words = builds_term_lexicon(
-        word = doc['word'], 
+        word = word, 
         lexicon = lexicon, 
         number_of_words = number_of_words, 
         number_of_postings = number_of_postings,
         byte_start = byte_offset, 
-        byte_end = byte_offset + doc_len
+        byte_end = byte_offset + doc_len,
+        max_freq = max_freq,
+        max_bm25 = max_bm25
     )       
     
     return byte_offset + doc_len, number_of_words, summed_n_docs
 
 
-def finishes_reading_index(f, output_file, lexicon, last_merge: bool, 
-    number_of_words: int, summed_n_docs: int, byte_offset: int) -> (int, int, int):
+def split_term_space(runs: list[str], number_of_segments: int) -> list[(str, str, int)]:
+    """
+    Splits the terms of all runs in ranges holding about the same number of postings,
+    returns the first term of each range, the first term of the next one and the id of its first term
+    """
+
+    if number_of_segments <= 1:
+        return [(None, None, 0)]
+
+    term_postings = {}
+    for run in runs:
+        for term, count in read_run_terms(run):
+            term_postings[term] = term_postings.get(term, 0) + count
+
+    terms = sorted(term_postings)
+    total_postings = sum(term_postings.values())
+
+    ranges = []; first_term_id = 0; summed_postings = 0
+    for term_id, term in enumerate(terms[:-1]):
+        summed_postings += term_postings[term]
+        if len(ranges) < number_of_segments - 1 and summed_postings >= total_postings * (len(ranges) + 1) / number_of_segments:
+            ranges.append((terms[first_term_id], terms[term_id + 1], first_term_id))
+            first_term_id = term_id + 1
+
+    ranges.append((terms[first_term_id] if terms else None, None, first_term_id))
+
+    return ranges
+
+
+def merge_term_range(index_path: str, runs: list[str], segment: str, first_term: str, end_term: str, first_term_id: int, format_version: int, collection_stats: dict) -> (int, int):
+    """
+    Merges the postings of the terms from first_term up to end_term of all runs at once, through a heap over the run cursors,
+    writing them as a segment of the inverted index and of the term lexicon
     """
-    Finishes reading the index and writes the rest of the lines to the output file
-    """    
 
-    for line in f.readlines():            
-        doc = json.loads(line)
-       
-        if last_merge:
+    seconds = time.time()
+    number_of_words = first_term_id; byte_offset = 0; summed_n_docs = 0
+
+    cursors = [RunCursor(run, first_term) for run in runs]
+    heap = [(cursor.term, idx) for idx, cursor in enumerate(cursors) if cursor.term is not None]
+    heapq.heapify(heap)
+
+    with open(segment + ".index.tmp", 'wb') as output_file, open(segment + ".lexicon.tmp", 'w') as lexicon:
+        while heap and (end_term is None or heap[0][0] < end_term):
+            word = heap[0][0]
+
+            doc_ids = []; freqs = []
+            while heap and heap[0][0] == word:
+                _, idx = heapq.heappop(heap)
+                run_doc_ids, run_freqs = cursors[idx].postings()
+                doc_ids.append(run_doc_ids); freqs.append(run_freqs)
+
+                if cursors[idx].next() is not None:
+                    heapq.heappush(heap, (cursors[idx].term, idx))
+
+            # The runs hold corpus ids, the index their dense doc ids
+            doc_ids = to_doc_ids(collection_stats["corpus_ids"], np.concatenate(doc_ids), collection_stats["corpus_id_sorter"]); freqs = np.concatenate(freqs)
+            order = np.argsort(doc_ids, kind="stable")
+
             byte_offset, number_of_words, summed_n_docs = builds_last_index(
-                output_file, doc, lexicon, number_of_words, summed_n_docs, byte_offset
+                output_file, word, doc_ids[order], freqs[order], lexicon, number_of_words, summed_n_docs, byte_offset, format_version, collection_stats
             )
-        else:
-            output_file.write(json.dumps(doc) + "\n")
-                                                                   
-    return number_of_words, summed_n_docs, byte_offset
 
+    for cursor in cursors:
+        cursor.close()
+
+    os.replace(segment + ".index.tmp", segment + ".index")
+    os.replace(segment + ".lexicon.tmp", segment + ".lexicon")
 
-def merger(index_path: str, first_file: str, second_file: str, last_merge=False):
+    logging.info(f"Time to merge segment {segment}: {time.time() - seconds} seconds")
+
+    return number_of_words - first_term_id, summed_n_docs
+
+
+def merge_term_range_task(task: (int, tuple)) -> (int, (int, int), Exception):
     """
-    Merges two files into one
-    """    
-    
-    number_of_words = 0; byte_offset = 0; summed_n_docs = 0
-    output_file_path = index_path + "inverted_index" if last_merge else index_path + "inverted_indexes/" + first_file + second_file
-    
-    logging.info(f"Merging {index_path}inverted_indexes/{first_file} and {index_path}inverted_indexes/{second_file} into {output_file_path}")
-
-    if last_merge:
-        output_file = open(output_file_path, 'wb')
-    else :
-        output_file = open(output_file_path, 'w')
-        
-    with open(index_path + "inverted_indexes/" + first_file, 'r') as ff, open(index_path + "inverted_indexes/" + second_file, 'r') as fs, open(index_path + "term_lexicon.txt", 'w') as lexicon:    
-        
-        ff_line = ff.readline()
-        fs_line = fs.readline()
-        while True:  
-            if ff_line == "":                                                                         
-                number_of_words, summed_n_docs, byte_offset = finishes_reading_index(fs, output_file, lexicon, last_merge, number_of_words, summed_n_docs, byte_offset)    
-                break
-            
-            elif fs_line == "":                                                                    
-                number_of_words, summed_n_docs, byte_offset = finishes_reading_index(ff, output_file, lexicon, last_merge, number_of_words, summed_n_docs,byte_offset)     
-                break
-            
-            elif ff_line == "" and fs_line == "":                                                      
-                break
-            
-            else:                                                                                   
-                ff_doc = json.loads(ff_line); fs_doc = json.loads(fs_line)                           
-                if  ff_doc['word'] == fs_doc['word']:     
-
-                    ff_doc['docs'] += fs_doc['docs']
-
-                    if last_merge:
-                        byte_offset, number_of_words, summed_n_docs = builds_last_index(output_file, ff_doc, lexicon, number_of_words, summed_n_docs, byte_offset)
-                    else:
-                        output_file.write(json.dumps(ff_doc) + "\n")                                            
-                                                                          
-                    ff_line = ff.readline(); fs_line = fs.readline()                              
-                
-                elif ff_doc['word'] < fs_doc['word']:                                                
-
-                    if last_merge:
-                        byte_offset, number_of_words, summed_n_docs = builds_last_index(output_file, ff_doc, lexicon, number_of_words, summed_n_docs, byte_offset)
-                    else:
-                        output_file.write(json.dumps(ff_doc) + "\n")       
-
-                    ff_line = ff.readline()                                                         
-                
-                else:                                                                                  
-
-                    if last_merge:
-                        byte_offset, number_of_words, summed_n_docs = builds_last_index(output_file, fs_doc, lexicon, number_of_words, summed_n_docs, byte_offset)
-                    else:
-                        output_file.write(json.dumps(fs_doc) + "\n")     
-
-                    fs_line = fs.readline()                                                         
-                
-    output_file.close()
-
-    os.remove(os.path.join(index_path + "inverted_indexes/", first_file))                                     
-    os.remove(os.path.join(index_path + "inverted_indexes/", second_file))
-
-                                                        
-    if last_merge:
-        save_index_statistics(number_of_words, summed_n_docs, index_path)
-
-
-    time.sleep(1)
+    Merges a range of terms, returning its error instead of raising it so that the other ranges are still recorded as merged
+    """
+
+    try:
+        return task[0], merge_term_range(*task[1]), None
+    except Exception as error:
+        return task[0], None, error
+
+
+def concatenates_segments(index_path: str, segments: list[str]):
+    """
+    Concatenates the segments into the inverted index, shifting the byte offsets of their lexicons,
+    the segments are kept until the build manifest records the inverted index
+    """
+
+    if len(segments) == 1:
+        # A resumed build may have moved one of the files already
+        for extension, file_name in ((".index", "inverted_index"), (".lexicon", "term_lexicon.txt")):
+            if os.path.isfile(segments[0] + extension):
+                os.replace(segments[0] + extension, index_path + file_name)
+        return
+
+    byte_offset = 0
+    with open(index_path + "inverted_index.tmp", 'wb') as output_file, open(index_path + "term_lexicon.txt.tmp", 'w') as lexicon:
+        for segment in segments:
+            with open(segment + ".lexicon", 'r') as f:
+                for line in f:
+                    word, word_id, byte_start, byte_end, rest = line.split(" ", 4)
+                    lexicon.write(f"{word} {word_id} {int(byte_start) + byte_offset} {int(byte_end) + byte_offset} {rest}")
+
+            with open(segment + ".index", 'rb') as f:
+                shutil.copyfileobj(f, output_file)
+
+            byte_offset += os.path.getsize(segment + ".index")
+
+    os.replace(index_path + "inverted_index.tmp", index_path + "inverted_index")
+    os.replace(index_path + "term_lexicon.txt.tmp", index_path + "term_lexicon.txt")
 
 
 def clear_output_folders(index_path: str):
     """
-    Deletes all files in the output folders
+    Deletes the output folders with all their files
+    """
+
+    for folder in BUILD_FOLDERS:
+        shutil.rmtree(index_path + folder, ignore_errors=True)
+
+
+def read_word_scores(index_path: str, collection_stats: dict, k1: float, b: float):
+    """
+    Yields the doc ids of every word of the final index with their BM25 scores
     """
 
-    for file in os.listdir(index_path + "inverted_indexes/"):
-        os.remove(os.path.join(index_path + "inverted_indexes/", file))
+    metadata = read_index_metadata(index_path)
 
-    for file in os.listdir(index_path + "shards/"):
-        os.remove(os.path.join(index_path + "shards/", file))
+    with open(index_path + "term_lexicon.txt", 'r') as lexicon, open(index_path + "inverted_index", 'rb') as index_file:
+        for line in lexicon:
+            word, word_id, byte_start, byte_end, number_of_postings = line.split(" ")[:5]
 
-    for file in os.listdir(index_path + "doc_indexes/"):
-        os.remove(os.path.join(index_path + "doc_indexes/", file))
+            index_file.seek(int(byte_start))
+            byte_array = index_file.read(int(byte_end) - int(byte_start))
+            _, doc_ids, freqs = decode_postings(byte_array, metadata["format_version"], metadata.get("block_size", BLOCK_SIZE))
 
-    for file in os.listdir(index_path + "doc_lens/"):
-        os.remove(os.path.join(index_path + "doc_lens/", file))
+            idf = math.log10(collection_stats["number_of_documents"]/len(doc_ids))
 
+            yield doc_ids, bm25(idf, freqs, collection_stats["doc_lens"][doc_ids], collection_stats["avg_doc_len"], b, k1)
 
-    os.rmdir(index_path + "shards/")
-    os.rmdir(index_path + "inverted_indexes/")
-    os.rmdir(index_path + "doc_indexes/")
-    os.rmdir(index_path + "doc_lens/")
 
+def check_impact_bits(impact_bits: int) -> None:
+    """
+    Raises a ValueError when the impacts can not be quantized to impact_bits bits, 0 builds no impact index
+    """
+
+    if impact_bits != 0 and not 1 <= impact_bits <= MAX_IMPACT_BITS:
+        raise ValueError(f"Impacts are quantized to 1 to {MAX_IMPACT_BITS} bits, got {impact_bits}")
 
-def run_merger_thread_pool(index_path: str, number_of_threads: int):
+
+def build_impact_index(index_path: str, collection_stats: dict, impact_bits: int, k1: float = 1.2, b: float = 0.75):
     """
-    Creates a thread pool for merging indexes
+    Builds the impact index: BM25 scores quantized to impact_bits bits, with postings ordered by decreasing impact
     """
 
     seconds = time.time()
+    check_impact_bits(impact_bits)
 
-    while True:
-    
-        notice_files = os.listdir(index_path + "inverted_indexes/")
-        number_of_files = math.floor(len(notice_files)/2) * 2
+    max_score = max((scores.max() for _, scores in read_word_scores(index_path, collection_stats, k1, b)), default=0)
+    impact_scale = max_score / (2 ** impact_bits - 1) if max_score > 0 else 1.0
 
-        if len(notice_files) == 2:
-            merger(index_path, notice_files[0], notice_files[1], True)
-            break
+    byte_offsets = [0]
+    with open(index_path + "impact_index", 'wb') as output_file:
+        for doc_ids, scores in read_word_scores(index_path, collection_stats, k1, b):
+            bin_array = encode_impact_postings(doc_ids, np.round(scores / impact_scale).astype(np.int64))
+            output_file.write(bin_array)
+            byte_offsets.append(byte_offsets[-1] + len(bin_array))
 
-        with Pool(number_of_threads) as pool:
-            pool.starmap(merger, [(index_path, notice_files[i], notice_files[i+1], False) for i in range(0, number_of_files, 2)]) 
+    # Offsets of the impact ordered list of every word, indexed by word id
+    np.array(byte_offsets, dtype=">u8").tofile(index_path + "impact_offsets")
 
+    save_index_metadata(index_path, {
+        "impact_bits": impact_bits, "impact_scale": impact_scale, "impact_k1": k1, "impact_b": b,
+        "impact_number_of_documents": collection_stats["number_of_documents"]
+    })
+
+    logging.info(f"Time to quantize the impacts: {time.time() - seconds} seconds")
+
+
+def run_merger_thread_pool(index_path: str, number_of_threads: int, format_version: int = FORMAT_VERSION, impact_bits: int = 0, merge_segments: int = 1, document_compression: str = "none", doc_order: str = "id", corpus_path: str = None, positions: bool = False):
+    """
+    Merges all runs in a single pass, split in merge_segments ranges of terms merged in parallel,
+    the ranges and the stages completed by an interrupted build are not done again
+    """
+
+    seconds = time.time()
+    manifest = load_build_manifest(index_path)
+
+    runs = list_runs(index_path + "runs/")
+
+    collection_stats = load_collection_statistics(index_path, doc_order, corpus_path)
+    save_doc_lens(index_path, collection_stats["doc_lens"], collection_stats["number_of_documents"], collection_stats["avg_doc_len"])
+    save_document_ids(index_path, collection_stats["corpus_ids"], doc_order)
+
+    if not os.path.isdir(index_path + "segments/"):
+        os.mkdir(index_path + "segments/")
+
+    if manifest["term_ranges"] is None:
+        manifest["term_ranges"] = split_term_space(runs, merge_segments)
+        save_build_manifest(index_path, manifest)
+
+    tasks = [
+        (index_path, runs, f"{index_path}segments/{idx:04d}", first_term, end_term, first_term_id, format_version, collection_stats)
+        for idx, (first_term, end_term, first_term_id) in enumerate(manifest["term_ranges"])
+    ]
+
+    pending = [idx for idx in range(len(tasks)) if str(idx) not in manifest["completed_ranges"]]
+    if "inverted_index" in manifest["completed_stages"]:
+        pending = []
+
+    errors = []
+    def record_merged_ranges(merged_ranges):
+        for idx, range_stats, error in merged_ranges:
+            if error is not None:
+                logging.info(f"Merge of segment {idx:04d} failed: {error!r}")
+                errors.append(error)
+            else:
+                manifest["completed_ranges"][str(idx)] = range_stats
+                save_build_manifest(index_path, manifest)
+
+    if len(pending) == 1:
+        record_merged_ranges([merge_term_range_task((pending[0], tasks[pending[0]]))])
+    elif pending:
+        with Pool(min(number_of_threads, len(pending))) as pool:
+            record_merged_ranges(pool.imap_unordered(merge_term_range_task, [(idx, tasks[idx]) for idx in pending]))
+
+    if errors:
+        raise errors[0]
+
+    if "inverted_index" not in manifest["completed_stages"]:
+        segment_stats = [manifest["completed_ranges"][str(idx)] for idx in range(len(tasks))]
+        concatenates_segments(index_path, [task[2] for task in tasks])
+        save_index_statistics(sum(words for words, _ in segment_stats), sum(n_docs for _, n_docs in segment_stats), index_path)
+        save_index_metadata(index_path, {"format_version": format_version, "block_size": BLOCK_SIZE})
+        complete_stage(index_path, manifest, "inverted_index")
+
+    # The merged segments are only needed until the inverted index is recorded
+    shutil.rmtree(index_path + "segments/", ignore_errors=True)
+
+    if impact_bits > 0 and "impact_index" not in manifest["completed_stages"]:
+        build_impact_index(index_path, collection_stats, impact_bits)
+        complete_stage(index_path, manifest, "impact_index")
+
+    if "document_store" not in manifest["completed_stages"]:
+        build_document_store(index_path, number_of_threads, collection_stats["corpus_ids"], document_compression)
+        complete_stage(index_path, manifest, "document_store")
+
+    # Positions are read back from the document store, they are kept out of the inverted index
+    if positions and "positional_index" not in manifest["completed_stages"]:
+        build_positional_index(index_path, number_of_threads)
+        complete_stage(index_path, manifest, "positional_index")
+    elif not positions:
+        remove_positional_index(index_path)
 
-    subprocess.Popen(f"cat {index_path}doc_indexes/* > {index_path}document_index", shell=True)
-    time.sleep(15)
     logging.info(f"Time to merge all files: {time.time() - seconds} seconds")
-    subprocess.Popen(f"cat {index_path}doc_lens/* > {index_path}document_lens", shell=True)
-    time.sleep(15)
-    logging.info(f"Time to merge lens: {time.time() - seconds} seconds")
 
   
     clear_output_folders(index_path)
-
+    finish_build(index_path)
@@ -0,0 +1,45 @@
+import os, json
+
+
+# Indexes written before the metadata file existed use fixed width postings
+DEFAULT_METADATA = {"format_version": 1}
+
+
+def save_index_metadata(index_path: str, metadata: dict) -> None:
+    """
+    Saves the index metadata, keeping the fields already stored
+    """
+
+    stored_metadata = read_index_metadata(index_path)
+    stored_metadata.update(metadata)
+
+    with open(os.path.join(index_path, "index_metadata.json"), 'w') as fp:
+        json.dump(stored_metadata, fp)
+
+
+def read_index_metadata(index_path: str) -> dict:
+    """
+    Reads the index metadata from disk
+    """
+
+    metadata = dict(DEFAULT_METADATA)
+
+    metadata_path = os.path.join(index_path, "index_metadata.json")
+    if os.path.isfile(metadata_path):
+        with open(metadata_path, 'r') as fp:
+            metadata.update(json.load(fp))
+
+    return metadata
+
+
+_metadata = {}
+
+def load_index_metadata(index_path: str) -> dict:
+    """
+    Returns the index metadata, reading it only once per worker
+    """
+
+    if index_path not in _metadata:
+        _metadata[index_path] = read_index_metadata(index_path)
+
+    return _metadata[index_path]
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+
+
+# Postings of a run, sorted by term id and then by doc id, the term id is the position of the term in the run
+RUN_POSTING_DTYPE = np.dtype([("term_id", ">u4"), ("doc_id", ">u4"), ("freq", ">u4")])
+
+# Length of every document indexed by a partition
+DOC_LEN_RECORD_DTYPE = np.dtype([("doc_id", ">u4"), ("len", ">u4")])
+
+
+def write_run(run_path: str, terms: list[str], term_ids: np.ndarray, doc_ids: np.ndarray, freqs: np.ndarray) -> None:
+    """
+    Writes a sorted run: its binary postings, then its terms in order with their number of postings
+    """
+
+    counts = np.bincount(term_ids, minlength=len(terms))
+
+    postings = np.empty(len(doc_ids), dtype=RUN_POSTING_DTYPE)
+    postings["term_id"] = term_ids
+    postings["doc_id"] = doc_ids
+    postings["freq"] = freqs
+    postings.tofile(run_path + ".postings")
+
+    # The run is only listed once its terms are renamed in place, after its postings are written
+    with open(run_path + ".terms.tmp", 'w') as fp:
+        for term, count in zip(terms, counts.tolist()):
+            fp.write(f"{term} {count}\n")
+
+    os.replace(run_path + ".terms.tmp", run_path + ".terms")
+
+
+def read_run_terms(run_path: str) -> list[(str, int)]:
+    """
+    Reads the terms of a run with their number of postings
+    """
+
+    with open(run_path + ".terms", 'r') as fp:
+        return [(term, int(count)) for term, count in (line.split(" ") for line in fp)]
+
+
+class RunCursor:
+    """
+    Cursor over the terms of a sorted run, reading the postings of one term at a time
+    """
+
+    def __init__(self, run_path: str, first_term: str = None):
+
+        self.terms_file = open(run_path + ".terms", 'r')
+        self.postings_file = open(run_path + ".postings", 'rb')
+        self.term = None
+        self.count = 0
+
+        # Skips the terms before first_term, with their postings
+        skipped_postings = 0
+        self.next()
+        while self.term is not None and first_term is not None and self.term < first_term:
+            skipped_postings += self.count
+            self.next()
+
+        self.postings_file.seek(skipped_postings * RUN_POSTING_DTYPE.itemsize)
+
+
+    def next(self) -> str:
+        """
+        Moves to the next term of the run, None at its end
+        """
+
+        line = self.terms_file.readline()
+        if not line:
+            self.term = None
+            self.count = 0
+        else:
+            self.term, count = line.split(" ")
+            self.count = int(count)
+
+        return self.term
+
+
+    def postings(self) -> (np.ndarray, np.ndarray):
+        """
+        Reads the doc ids and frequencies of the current term, it has to be called once before moving to the next term
+        """
+
+        postings = np.frombuffer(self.postings_file.read(self.count * RUN_POSTING_DTYPE.itemsize), dtype=RUN_POSTING_DTYPE)
+
+        return postings["doc_id"].astype(np.int64), postings["freq"].astype(np.int64)
+
+
+    def close(self) -> None:
+        self.terms_file.close()
+        self.postings_file.close()
+
+
+def remove_run(run_path: str) -> None:
+    """
+    Deletes the files of a run
+    """
+
+    os.remove(run_path + ".terms")
+    os.remove(run_path + ".postings")
+
+
+def list_runs(runs_path: str) -> list[str]:
+    """
+    Returns the paths of the runs in a folder, in name order
+    """
+
+    return [os.path.join(runs_path, file_name[:-len(".terms")]) for file_name in sorted(os.listdir(runs_path)) if file_name.endswith(".terms")]
@@ -0,0 +1,152 @@
+import os, json
+
+import numpy as np
+
+from document_lengths import load_document_lengths
+from document_ids import load_document_ids
+from document_store import load_document_store
+
+
+# Segments of an index updated in place, the first one is the index the updates started from or the last compaction
+SEGMENTS_MANIFEST = "segments.json"
+
+
+def read_manifest(index_path: str) -> dict:
+    """
+    Reads the segments of an index, None for an index that was never updated
+    """
+
+    manifest_path = os.path.join(index_path, SEGMENTS_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path, 'r') as fp:
+        return json.load(fp)
+
+
+def save_manifest(index_path: str, manifest: dict) -> None:
+    """
+    Replaces the manifest at once, readers see either the old segments or the new ones
+    """
+
+    manifest_path = os.path.join(index_path, SEGMENTS_MANIFEST)
+    with open(manifest_path + ".tmp", 'w') as fp:
+        json.dump(manifest, fp)
+
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def read_deletions(deletions_path: str, number_of_ids: int) -> np.ndarray:
+    """
+    Reads the deletion bitmap, one bit per doc id of the segments
+    """
+
+    deleted = np.zeros(number_of_ids, dtype=bool)
+    if deletions_path is not None:
+        bits = np.unpackbits(np.fromfile(deletions_path, dtype=np.uint8), bitorder='little')
+        deleted[:min(len(bits), number_of_ids)] = bits[:number_of_ids].astype(bool)
+
+    return deleted
+
+
+def save_deletions(deletions_path: str, deleted: np.ndarray) -> None:
+    np.packbits(deleted, bitorder='little').tofile(deletions_path)
+
+
+class SegmentedIndex:
+    """
+    Segments of an index seen as one: the doc ids of a segment follow the ones of the segments before it,
+    and the collection statistics only count the documents that were not deleted
+    """
+
+    def __init__(self, index_path: str, manifest: dict):
+
+        self.generation = manifest["generation"]
+        self.paths = [os.path.join(index_path, segment) for segment in manifest["segments"]]
+
+        doc_lens = [load_document_lengths(path)[0] for path in self.paths]
+        self.bases = np.cumsum([0] + [len(segment_doc_lens) for segment_doc_lens in doc_lens])
+        self.doc_lens = np.concatenate(doc_lens).astype(np.int64)
+        self.corpus_ids = np.concatenate([load_document_ids(path)[0] for path in self.paths]).astype(np.int64)
+        # Delta segments and indexes ordered by title give doc ids out of corpus id order
+        self.in_corpus_id_order = bool(np.all(np.diff(self.corpus_ids) > 0))
+
+        deletions = manifest.get("deletions")
+        self.deleted = read_deletions(os.path.join(index_path, deletions) if deletions else None, len(self.doc_lens))
+        self.has_deletions = bool(self.deleted.any())
+
+        live_doc_lens = self.doc_lens[~self.deleted]
+        self.number_of_documents = len(live_doc_lens)
+        self.avg_doc_len = int(live_doc_lens.sum())/self.number_of_documents if self.number_of_documents else 0.0
+
+        self.live_doc_ids = np.flatnonzero(~self.deleted)
+        self.live_sorter = np.argsort(self.corpus_ids[self.live_doc_ids], kind="stable")
+
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+    def is_single(self) -> bool:
+        """
+        Whether the index is a single segment without deletions, which is read as a plain index
+        """
+
+        return len(self.paths) == 1 and not self.has_deletions
+
+
+    def find(self, corpus_id: int) -> (str, int):
+        """
+        Returns the segment holding the live document with a corpus id and its doc id in the segment, None when it is not in the index
+        """
+
+        live_corpus_ids = self.corpus_ids[self.live_doc_ids]
+        position = int(np.searchsorted(live_corpus_ids, corpus_id, sorter=self.live_sorter))
+        if position == len(live_corpus_ids) or live_corpus_ids[self.live_sorter[position]] != corpus_id:
+            return None
+
+        doc_id = int(self.live_doc_ids[self.live_sorter[position]])
+        segment_idx = int(np.searchsorted(self.bases, doc_id, side='right')) - 1
+
+        return self.paths[segment_idx], doc_id - int(self.bases[segment_idx])
+
+
+    def iter_documents(self):
+        """
+        Yields the corpus id and the preprocessed tokens of every document that was not deleted, segment by segment
+        """
+
+        for segment_path, base in zip(self.paths, self.bases.tolist()):
+            corpus_ids = load_document_ids(segment_path)[0]
+            for doc_id, terms in load_document_store(segment_path).iter_documents():
+                if not self.deleted[base + doc_id]:
+                    yield corpus_ids.item(doc_id), terms
+
+
+_segments = {}
+
+def refresh_segments(index_path: str) -> None:
+    """
+    Reloads the segments of the index when an update replaced its manifest since they were loaded
+    """
+
+    try:
+        stat = os.stat(os.path.join(index_path, SEGMENTS_MANIFEST))
+        version = (stat.st_ino, stat.st_mtime_ns)
+    except FileNotFoundError:
+        version = None
+
+    if index_path not in _segments or _segments[index_path][0] != version:
+        manifest = read_manifest(index_path) if version is not None else None
+        _segments[index_path] = (version, SegmentedIndex(index_path, manifest) if manifest is not None else None)
+
+
+def load_segments(index_path: str) -> SegmentedIndex:
+    """
+    Returns the segments of the index as loaded by the last refresh, None for an index that was never updated
+    """
+
+    if index_path not in _segments:
+        refresh_segments(index_path)
+
+    return _segments[index_path][1]
@@ -0,0 +1,280 @@
+import argparse, os, logging, json, time, shutil, psutil
+
+import numpy as np
+
+from preprocesser import partition_corpus
+from index_builder import run_indexer_thread_pool
+from index_merger import run_merger_thread_pool
+from index_metadata import read_index_metadata
+from index_runs import RUN_POSTING_DTYPE, DOC_LEN_RECORD_DTYPE
+from index_segments import read_manifest, save_manifest, save_deletions, SegmentedIndex
+from document_ids import load_document_ids
+from document_store import load_document_store
+from postings import decode_postings, BLOCK_SIZE
+from build_manifest import start_build, corpus_signature, INDEX_FILES
+
+logging.basicConfig(filename=f'main.log', level=logging.INFO)
+
+PARTITIONS_PER_THREAD = 4
+
+# Delta segments an index can have before an update compacts it
+MAX_DELTA_SEGMENTS = 8
+
+# Manifest of an index that was never updated: the index built by indexer.py is its only segment
+BASE_MANIFEST = {"generation": 0, "segments": [""], "deletions": None}
+
+
+
+def load_index_segments(index_path: str) -> (dict, SegmentedIndex):
+    """
+    Reads the manifest and the segments of an index, raises a ValueError when a segment was built before the dense doc ids
+    """
+
+    manifest = read_manifest(index_path) or dict(BASE_MANIFEST)
+
+    for segment in manifest["segments"]:
+        if load_document_ids(os.path.join(index_path, segment)) is None:
+            raise ValueError(f"Segment '{segment}' of {index_path} has no document ids, the index has to be rebuilt with indexer.py before it can be updated")
+
+    return manifest, SegmentedIndex(index_path, manifest)
+
+
+def remove_superseded_files(index_path: str, manifests: list[dict]) -> None:
+    """
+    Removes the segments, the deletion bitmaps and the files of the index built by indexer.py that none of the given manifests uses
+    """
+
+    segments = {segment for manifest in manifests for segment in manifest["segments"]}
+    deletions = {manifest.get("deletions") for manifest in manifests}
+
+    for file_name in os.listdir(index_path):
+        if file_name.startswith("deletions_") and file_name not in deletions:
+            os.remove(index_path + file_name)
+        elif file_name.startswith("segment_") and os.path.isdir(index_path + file_name) and file_name not in segments:
+            shutil.rmtree(index_path + file_name)
+
+    if "" not in segments:
+        for index_file in INDEX_FILES:
+            if os.path.isfile(index_path + index_file):
+                os.remove(index_path + index_file)
+
+
+def commit_segments(index_path: str, manifest: dict, segments: list[str], deleted: np.ndarray) -> int:
+    """
+    Writes the deletion bitmap and replaces the manifest with the next generation of segments, returns that generation
+    """
+
+    generation = manifest["generation"] + 1
+
+    deletions = None
+    if deleted.any():
+        deletions = f"deletions_{generation:04d}"
+        save_deletions(index_path + deletions, deleted)
+
+    next_manifest = {"generation": generation, "segments": segments, "deletions": deletions}
+    save_manifest(index_path, next_manifest)
+
+    # Queries that loaded the previous manifest may still open its files, they are only removed by the next commit
+    remove_superseded_files(index_path, [next_manifest, manifest])
+
+    return generation
+
+
+def add_documents(index_path: str, corpus_path: str, number_of_threads: int, memory_limit: int, max_segments: int = MAX_DELTA_SEGMENTS) -> None:
+    """
+    Indexes the documents of corpus_path in a new delta segment, documents already in the index with the same id are replaced;
+    once the index has more than max_segments delta segments the add also compacts the whole index
+    """
+
+    seconds = time.time()
+    manifest, segments = load_index_segments(index_path)
+    metadata = read_index_metadata(segments.paths[0])
+
+    if os.path.getsize(corpus_path) == 0:
+        raise ValueError(f"Corpus {corpus_path} has no documents to add")
+
+    segment = f"segment_{manifest['generation'] + 1:04d}"
+    segment_path = index_path + segment + "/"
+    # An add that was interrupted left the delta of the same generation, which is resumed when it indexes the same corpus
+    os.makedirs(segment_path, exist_ok=True)
+    start_build(segment_path, {"corpus": corpus_signature(corpus_path)})
+
+    # Deltas are small, they keep the postings format and the compression of the index but not its impact index, its positions or its doc id order
+    run_indexer_thread_pool(corpus_path, segment_path, number_of_threads, partition_corpus(corpus_path, number_of_threads * PARTITIONS_PER_THREAD), memory_limit)
+    run_merger_thread_pool(segment_path, number_of_threads, metadata["format_version"], 0, 1, metadata.get("document_store_compression", "none"))
+
+    corpus_ids = load_document_ids(segment_path)[0]
+    replaced = np.isin(segments.corpus_ids, corpus_ids) & ~segments.deleted
+    deleted = np.concatenate([segments.deleted | replaced, np.zeros(len(corpus_ids), dtype=bool)])
+
+    commit_segments(index_path, manifest, manifest["segments"] + [segment], deleted)
+
+    logging.info(f"Time to add {len(corpus_ids)} documents from {corpus_path} to {index_path} as segment {segment}, replacing {int(replaced.sum())}: {time.time() - seconds} seconds")
+
+    # The first segment is not a delta
+    if len(manifest["segments"]) > max_segments:
+        if metadata.get("doc_order", "id") == "title":
+            logging.warning(f"Index {index_path} has {len(manifest['segments'])} delta segments, it is ordered by title and has to be compacted with its corpus")
+        else:
+            logging.warning(f"Index {index_path} has {len(manifest['segments'])} delta segments, more than {max_segments}: compacting every segment into one")
+            compact_index(index_path, number_of_threads)
+
+
+def delete_documents(index_path: str, corpus_ids: list[int]) -> int:
+    """
+    Marks the documents with the given corpus ids as deleted, returns the number of documents deleted
+    """
+
+    manifest, segments = load_index_segments(index_path)
+
+    deleted = np.isin(segments.corpus_ids, np.asarray(corpus_ids, dtype=np.int64)) & ~segments.deleted
+    if deleted.any():
+        commit_segments(index_path, manifest, manifest["segments"], segments.deleted | deleted)
+
+    logging.info(f"Deleted {int(deleted.sum())} documents from {index_path}")
+
+    return int(deleted.sum())
+
+
+def write_segment_run(segment_path: str, run_path: str, corpus_ids: np.ndarray, deleted: np.ndarray) -> None:
+    """
+    Writes the postings of the documents of a segment that were not deleted as a sorted run with their corpus ids,
+    one term at a time in the order of its lexicon
+    """
+
+    metadata = read_index_metadata(segment_path)
+    term_id = 0
+
+    with open(os.path.join(segment_path, "term_lexicon.txt"), 'r') as lexicon, open(os.path.join(segment_path, "inverted_index"), 'rb') as index_file, \
+         open(run_path + ".terms", 'w') as fterms, open(run_path + ".postings", 'wb') as fpostings:
+        for line in lexicon:
+            word, _, byte_start, byte_end = line.split(" ")[:4]
+
+            index_file.seek(int(byte_start))
+            _, doc_ids, freqs = decode_postings(index_file.read(int(byte_end) - int(byte_start)), metadata["format_version"], metadata.get("block_size", BLOCK_SIZE))
+
+            live = ~deleted[doc_ids]
+            if not live.any():
+                continue
+
+            postings = np.empty(int(live.sum()), dtype=RUN_POSTING_DTYPE)
+            postings["term_id"] = term_id
+            postings["doc_id"] = corpus_ids[doc_ids[live]]
+            postings["freq"] = freqs[live]
+
+            fterms.write(f"{word} {len(postings)}\n")
+            postings.tofile(fpostings)
+            term_id += 1
+
+
+def write_segment_documents(segment_path: str, output_path: str, file_name: str, doc_lens: np.ndarray, corpus_ids: np.ndarray, deleted: np.ndarray) -> None:
+    """
+    Writes the lengths and the doc index of the documents of a segment that were not deleted, as the indexer writes the ones of a partition
+    """
+
+    live = np.flatnonzero(~deleted)
+
+    records = np.empty(len(live), dtype=DOC_LEN_RECORD_DTYPE)
+    records["doc_id"] = corpus_ids[live]
+    records["len"] = doc_lens[live]
+    records.tofile(output_path + "doc_lens/" + file_name)
+
+    with open(output_path + "doc_indexes/" + file_name, 'w') as dindex:
+        for doc_id, terms in load_document_store(segment_path).iter_documents():
+            if not deleted[doc_id]:
+                dindex.write(json.dumps({"id": str(corpus_ids.item(doc_id)), "text": " ".join(terms)}) + "\n")
+
+
+def compact_index(index_path: str, number_of_threads: int, corpus_path: str = None) -> None:
+    """
+    Merges every segment into a single one without the deleted documents, through the runs and the merge of the indexer,
+    queries keep reading the old segments until the manifest is replaced and their files until the next commit; corpus_path gives the titles of indexes ordered by title
+    """
+
+    seconds = time.time()
+    manifest, segments = load_index_segments(index_path)
+    if segments.is_single():
+        logging.info(f"Index {index_path} is already compacted")
+        return
+
+    if segments.number_of_documents == 0:
+        logging.info(f"Index {index_path} has no documents left to compact")
+        return
+
+    metadata = read_index_metadata(segments.paths[0])
+    doc_order = metadata.get("doc_order", "id")
+    if doc_order == "title" and corpus_path is None:
+        raise ValueError("Compacting an index ordered by title needs the corpus to read the titles from")
+
+    segment = f"segment_{manifest['generation'] + 1:04d}"
+    segment_path = index_path + segment + "/"
+    # Left by a compaction that was interrupted, the manifest never listed it
+    shutil.rmtree(segment_path, ignore_errors=True)
+    for folder in ("", "runs/", "doc_indexes/", "doc_lens/"):
+        os.mkdir(segment_path + folder)
+
+    for idx, segment_dir in enumerate(segments.paths):
+        start, end = segments.bases[idx], segments.bases[idx + 1]
+        write_segment_run(segment_dir, segment_path + f"runs/{idx:04d}", segments.corpus_ids[start:end], segments.deleted[start:end])
+        write_segment_documents(segment_dir, segment_path, f"{idx:04d}", segments.doc_lens[start:end], segments.corpus_ids[start:end], segments.deleted[start:end])
+
+    run_merger_thread_pool(
+        segment_path, number_of_threads, metadata["format_version"], metadata.get("impact_bits", 0), 1,
+        metadata.get("document_store_compression", "none"), doc_order, corpus_path, metadata.get("positions", False)
+    )
+
+    # The segments replaced by the compaction are removed by the next commit
+    commit_segments(index_path, manifest, [segment], np.zeros(segments.number_of_documents, dtype=bool))
+
+    logging.info(f"Time to compact {len(segments)} segments of {index_path} with {segments.number_of_documents} documents into {segment}: {time.time() - seconds} seconds")
+
+
+def read_corpus_ids(ids_path: str) -> list[int]:
+    """
+    Reads the corpus ids of the documents to delete, one per line
+    """
+
+    with open(ids_path, 'r') as f:
+        return [int(line) for line in f if line.strip()]
+
+
+def main(index_path: str, action: str, corpus_path: str, ids_path: str, number_of_threads: int, memory_limit: int, max_segments: int):
+    """
+    Adds documents to an index, deletes them or compacts its segments, without rebuilding it with indexer.py
+    """
+
+    if not index_path.endswith("/"):
+        index_path += '/'
+
+    if memory_limit is None:
+        memory_limit = psutil.virtual_memory().available // (2 * 1024 * 1024)
+
+    if action == "add":
+        add_documents(index_path, corpus_path, number_of_threads, memory_limit, max_segments)
+    elif action == "delete":
+        print(f"{delete_documents(index_path, read_corpus_ids(ids_path))} documents deleted")
+    elif action == "compact":
+        compact_index(index_path, number_of_threads, corpus_path)
+    else:
+        raise ValueError(f"Unknown action {action}, expected one of add, delete, compact")
+
+    print(read_manifest(index_path))
+
+
+# $ python3 bm_25_tf_idf/index_updater.py -i indexer/ -a add -c data/new_documents.jsonl
+# $ python3 bm_25_tf_idf/index_updater.py -i indexer/ -a delete -d data/deleted_ids.txt
+# $ python3 bm_25_tf_idf/index_updater.py -i indexer/ -a compact
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Updates an index in place with delta segments.')
+
+    parser.add_argument('-i',dest='index_path',action='store',required=True,type=str)
+    parser.add_argument('-a',dest='action',action='store',required=True,type=str,help='add, delete or compact')
+    parser.add_argument('-c',dest='corpus_path',action='store',required=False,type=str,default=None)
+    parser.add_argument('-d',dest='ids_path',action='store',required=False,type=str,default=None)
+    parser.add_argument('-t',dest='number_of_threads',action='store',required=False,type=int,default=8)
+    parser.add_argument('-m',dest='memory_limit',action='store',required=False,type=int,default=None)
+    parser.add_argument('-s',dest='max_segments',action='store',required=False,type=int,default=MAX_DELTA_SEGMENTS,help='delta segments an index can have, an add past this number also compacts the whole index, which rebuilds it from all its segments')
+
+    args = parser.parse_args()
+    main(args.index_path, args.action, args.corpus_path, args.ids_path, args.number_of_threads, args.memory_limit, args.max_segments)
@@ -1,11 +1,18 @@
-import sys, argparse, os, logging, json, os, math, subprocess, time
-from preprocesser import breaks_corpus, get_term_lexicon
-from index_builder import index_shard, run_indexer_thread_pool
-from index_merger import run_merger_thread_pool
+import sys, argparse, os, logging, json, os, math, subprocess, time, psutil
+from preprocesser import partition_corpus, get_term_lexicon
+from index_builder import run_indexer_thread_pool
+from index_merger import run_merger_thread_pool, check_impact_bits
+from parsed_corpus import partition_parsed_corpus
+from document_store import check_compression
+from document_ids import check_doc_order
+from postings import FORMAT_VERSION
+from build_manifest import start_build, corpus_signature
 from collections import OrderedDict 
 
 logging.basicConfig(filename=f'main.log', level=logging.INFO)
 
+PARTITIONS_PER_THREAD = 4
+
 #number of documents, number of tokens == number of inverted lists
 # distribution of the number of postings per inverted list.
 
@@ -26,42 +33,57 @@ def print_indexer_statistics(index_path: str, corpus_path: str, full_time: int):
         json.dump(stats, fp)
 
 
-def main(corpus_path: str, index_path: str, verbose: bool, number_of_threads: int):
+def main(corpus_path: str, index_path: str, verbose: bool, number_of_threads: int, format_version: int, impact_bits: int, merge_segments: int, memory_limit: int, parsed_corpus_path: str, document_compression: str, doc_order: str, positions: bool):
     """
     Your main calls should be added here
     """
 
+    # Fails before indexing when the compression of the document store, the doc id order or the impact bits can not be used
+    check_compression(document_compression)
+    check_doc_order(doc_order)
+    check_impact_bits(impact_bits)
+
     if not index_path.endswith("/"):
         index_path += '/'
     
     if not os.path.isdir(index_path):
         os.mkdir(index_path) 
 
+    # A build interrupted with the same corpus and settings goes on from its last completed step
+    start_build(index_path, {
+        "corpus": corpus_signature(corpus_path), "parsed_corpus_path": parsed_corpus_path, "format_version": format_version, "impact_bits": impact_bits,
+        "merge_segments": merge_segments, "document_compression": document_compression, "doc_order": doc_order, "positions": positions
+    })
     
     full_time = time.time()
-    # Amount of pieces we can manage to process for each thread due to memory limit
-    number_of_divisions = 64 
-    
-    logging.info(f"Indexing corpus {corpus_path} of size to an indexer in {index_path} with {number_of_threads} threads")
-    logging.info(f"Were divinding the corpus in  {str(number_of_divisions)} pieces")
+    file_size = os.path.getsize(corpus_path) // (1024 * 1024)
 
-    seconds = time.time()
-    shards_path = breaks_corpus(corpus_path, index_path, number_of_divisions)
-    logging.info(f"Time to split the corpus: {time.time() - seconds} seconds")
+    if memory_limit is None:
+        memory_limit = psutil.virtual_memory().available // (2 * 1024 * 1024)
 
-    time.sleep(3)
+    # Workers flush runs when they reach their share of the memory, the pieces only balance the work between them
+    number_of_divisions = number_of_threads * PARTITIONS_PER_THREAD
+    
+    logging.info(f"Indexing corpus {corpus_path} of size {file_size} MB to an indexer in {index_path} with {number_of_threads} threads and {memory_limit} MB of memory")
+    logging.info(f"Were divinding the corpus in  {str(number_of_divisions)} pieces")
 
     seconds = time.time()    
-    run_indexer_thread_pool(index_path, number_of_threads, number_of_divisions)
-    logging.info(f"Time to index all shards: {time.time() - seconds} seconds")
+    if parsed_corpus_path is None:
+        run_indexer_thread_pool(corpus_path, index_path, number_of_threads, partition_corpus(corpus_path, number_of_divisions), memory_limit)
+    else:
+        # The corpus was already preprocessed by parsed_corpus.py, the workers only read its tokens
+        if not parsed_corpus_path.endswith("/"):
+            parsed_corpus_path += '/'
+        run_indexer_thread_pool(parsed_corpus_path, index_path, number_of_threads, partition_parsed_corpus(parsed_corpus_path, number_of_divisions), memory_limit, parsed=True)
+    logging.info(f"Time to index all partitions: {time.time() - seconds} seconds")
 
     seconds = time.time()    
-    run_merger_thread_pool(index_path, number_of_threads)
+    run_merger_thread_pool(index_path, number_of_threads, format_version, impact_bits, merge_segments, document_compression, doc_order, corpus_path, positions)
     logging.info(f"Time to merge all indexes: {time.time() - seconds} seconds")
 
 
     full_time = time.time() - full_time
-    logging.info(f"Total time to index corpus {corpus_path} of size {file_size} to an indexer in {index_path} with {number_of_threads} threads and {memory_limit} MB of memory: {full_time} seconds")
+    logging.info(f"Total time to index corpus {corpus_path} of size {file_size} MB to an indexer in {index_path} with {number_of_threads} threads and {memory_limit} MB of memory: {full_time} seconds")
     logging.info(f"------------------------------------------------------------------------------------------------------------------------------------")
 
 
@@ -76,8 +98,16 @@ if __name__ == "__main__":
     parser.add_argument('-i',dest='index_path',action='store',required=True,type=str)
     parser.add_argument('-v',dest='verbose',action='store',required=False,type=bool,default=False)
     parser.add_argument('-t',dest='number_of_threads',action='store',required=False,type=int,default=8)
+    parser.add_argument('-f',dest='format_version',action='store',required=False,type=int,default=FORMAT_VERSION)
+    parser.add_argument('-s',dest='impact_bits',action='store',required=False,type=int,default=0)
+    parser.add_argument('-p',dest='merge_segments',action='store',required=False,type=int,default=1)
+    parser.add_argument('-m',dest='memory_limit',action='store',required=False,type=int,default=None)
+    parser.add_argument('-r',dest='parsed_corpus_path',action='store',required=False,type=str,default=None)
+    parser.add_argument('-z',dest='document_compression',action='store',required=False,type=str,default="none")
+    parser.add_argument('-o',dest='doc_order',action='store',required=False,type=str,default="id")
+    parser.add_argument('-l',dest='positions',action='store_true',required=False,default=False)
 
     args = parser.parse_args()
-    main(args.corpus_path, args.index_path, args.verbose, args.number_of_threads)
+    main(args.corpus_path, args.index_path, args.verbose, args.number_of_threads, args.format_version, args.impact_bits, args.merge_segments, args.memory_limit, args.parsed_corpus_path, args.document_compression, args.doc_order, args.positions)
 
 
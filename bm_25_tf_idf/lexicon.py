@@ -0,0 +1,107 @@
+import os, mmap
+
+from array import array
+
+
+class Lexicon:
+    """
+    Sorted term lexicon mapped into memory, searched through a table of line offsets
+    """
+
+    def __init__(self, term_lexicon_path: str):
+
+        self.line_starts = array('Q')
+
+        if os.path.getsize(term_lexicon_path) == 0:
+            self.lexicon = b""
+            return
+
+        with open(term_lexicon_path, 'rb') as lexicon_file:
+            self.lexicon = mmap.mmap(lexicon_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        position = 0
+        while position < len(self.lexicon):
+            self.line_starts.append(position)
+            position = self.lexicon.find(b"\n", position) + 1
+            if position == 0:
+                break
+
+
+    def __len__(self) -> int:
+        return len(self.line_starts)
+
+
+    def get_line(self, line_idx: int) -> list[bytes]:
+        """
+        Returns the fields of the given lexicon line
+        """
+
+        line_start = self.line_starts[line_idx]
+        line_end = self.lexicon.find(b"\n", line_start)
+        if line_end == -1:
+            line_end = len(self.lexicon)
+
+        return self.lexicon[line_start:line_end].split(b" ")
+
+
+    def find(self, term: str) -> list[bytes]:
+        """
+        Binary search for term in the lexicon, returns the fields of its line
+        """
+
+        encoded_term = term.encode("utf-8")
+        low = 0; high = len(self.line_starts) - 1
+
+        while (low <= high):
+            mid = (low + high) // 2
+            fields = self.get_line(mid)
+            current_term = fields[0]
+
+            if (encoded_term == current_term):
+                return fields
+
+            elif (encoded_term > current_term):
+                low = mid + 1
+
+            else:
+                high = mid - 1
+
+        return None
+
+
+    def lookup(self, term: str) -> (str, int, int, int, int):
+        """
+        Returns the term id, the byte range of its inverted list and its number of postings
+        """
+
+        fields = self.find(term)
+        if fields is None:
+            return [None] * 5
+
+        return term, int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4])
+
+
+    def lookup_upper_bounds(self, term: str) -> (int, float):
+        """
+        Returns the highest frequency and the highest BM25 score of the term in any document,
+        None for indexes built without them
+        """
+
+        fields = self.find(term)
+        if fields is None or len(fields) < 7:
+            return None, None
+
+        return int(fields[5]), float(fields[6])
+
+
+_lexicons = {}
+
+def load_lexicon(index_path: str) -> Lexicon:
+    """
+    Returns the lexicon of the index, loading it only once per worker
+    """
+
+    if index_path not in _lexicons:
+        _lexicons[index_path] = Lexicon(os.path.join(index_path, 'term_lexicon.txt'))
+
+    return _lexicons[index_path]
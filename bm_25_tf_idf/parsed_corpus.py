@@ -0,0 +1,198 @@
+import argparse, os, logging, time, shutil
+
+import numpy as np
+
+from itertools import islice
+from multiprocessing import Pool
+from preprocesser import preprocess_many, get_document_text, partition_corpus, read_partition
+
+# Token ids of the documents, one after the other in the order of the corpus
+TOKEN_DTYPE = np.dtype(">u4")
+
+# Position of the tokens of every document in the token file
+DOCUMENT_RECORD_DTYPE = np.dtype([("doc_id", ">u4"), ("token_start", ">u8"), ("token_count", ">u4")])
+
+# Documents preprocessed together by a worker
+PARSE_BATCH_SIZE = 1000
+
+# Token ids remapped at a time when the partitions are concatenated
+REMAP_CHUNK_SIZE = 1 << 22
+
+PARTITIONS_PER_THREAD = 4
+
+
+def parse_partition(corpus_path: str, parsed_path: str, partition_idx: int, byte_start: int, byte_end: int) -> None:
+    """
+    Preprocesses a byte range of the corpus, writing its tokens with ids local to the partition
+    """
+
+    seconds = time.time()
+    file_name = parsed_path + f"partitions/{partition_idx:04d}"
+    vocabulary = {}
+    documents = []
+    number_of_tokens = 0
+
+    with open(file_name + ".tokens", 'wb') as ftokens:
+        corpus = read_partition(corpus_path, byte_start, byte_end)
+        while batch := list(islice(corpus, PARSE_BATCH_SIZE)):
+            token_ids = []
+            for doc, cleaned_text in zip(batch, preprocess_many([get_document_text(doc) for doc in batch])):
+                documents.append((int(doc['id']), number_of_tokens, len(cleaned_text)))
+                number_of_tokens += len(cleaned_text)
+                token_ids.extend(vocabulary.setdefault(word, len(vocabulary)) for word in cleaned_text)
+
+            np.array(token_ids, dtype=TOKEN_DTYPE).tofile(ftokens)
+
+    with open(file_name + ".vocabulary", 'w') as fp:
+        for word in vocabulary:
+            fp.write(word + "\n")
+
+    np.array(documents, dtype=DOCUMENT_RECORD_DTYPE).tofile(file_name + ".documents")
+
+    logging.info(f"Time to parse partition {partition_idx:04d}: {time.time() - seconds} seconds")
+
+
+def read_vocabulary(vocabulary_path: str) -> list[str]:
+    """
+    Reads a vocabulary, the id of a term is its line
+    """
+
+    with open(vocabulary_path, 'r') as fp:
+        return fp.read().splitlines()
+
+
+def concatenates_partitions(parsed_path: str, number_of_partitions: int) -> None:
+    """
+    Renumbers the tokens of the partitions with a vocabulary sorted for the whole corpus and concatenates them
+    """
+
+    seconds = time.time()
+    partitions = [parsed_path + f"partitions/{partition_idx:04d}" for partition_idx in range(number_of_partitions)]
+
+    vocabulary = sorted(set().union(*(read_vocabulary(partition + ".vocabulary") for partition in partitions)))
+    term_ids = {word: term_id for term_id, word in enumerate(vocabulary)}
+
+    with open(parsed_path + "vocabulary", 'w') as fp:
+        for word in vocabulary:
+            fp.write(word + "\n")
+
+    number_of_tokens = 0
+    with open(parsed_path + "tokens", 'wb') as ftokens, open(parsed_path + "documents", 'wb') as fdocuments:
+        for partition in partitions:
+            remap = np.array([term_ids[word] for word in read_vocabulary(partition + ".vocabulary")], dtype=np.int64)
+
+            tokens = np.fromfile(partition + ".tokens", dtype=TOKEN_DTYPE)
+            for chunk_start in range(0, len(tokens), REMAP_CHUNK_SIZE):
+                remap[tokens[chunk_start:chunk_start + REMAP_CHUNK_SIZE]].astype(TOKEN_DTYPE).tofile(ftokens)
+
+            documents = np.fromfile(partition + ".documents", dtype=DOCUMENT_RECORD_DTYPE)
+            documents["token_start"] += number_of_tokens
+            documents.tofile(fdocuments)
+
+            number_of_tokens += len(tokens)
+
+    shutil.rmtree(parsed_path + "partitions/")
+
+    logging.info(f"Time to concatenate {number_of_partitions} partitions with {len(vocabulary)} terms and {number_of_tokens} tokens: {time.time() - seconds} seconds")
+
+
+def load_parsed_corpus(parsed_path: str) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Returns the vocabulary, the document records and the memory mapped token ids of a parsed corpus
+    """
+
+    vocabulary = np.array(read_vocabulary(parsed_path + "vocabulary"), dtype=object)
+    documents = np.fromfile(parsed_path + "documents", dtype=DOCUMENT_RECORD_DTYPE)
+
+    if os.path.getsize(parsed_path + "tokens") == 0:
+        tokens = np.empty(0, dtype=TOKEN_DTYPE)
+    else:
+        tokens = np.memmap(parsed_path + "tokens", dtype=TOKEN_DTYPE, mode='r')
+
+    return vocabulary, documents, tokens
+
+
+def partition_parsed_corpus(parsed_path: str, number_of_divisions: int) -> list[(int, int)]:
+    """
+    Splits the documents of a parsed corpus in ranges of about the same number of tokens
+    """
+
+    documents = np.fromfile(parsed_path + "documents", dtype=DOCUMENT_RECORD_DTYPE)
+    if len(documents) == 0:
+        return [(0, 0)]
+
+    number_of_tokens = int(documents["token_start"][-1]) + int(documents["token_count"][-1])
+    bounds = np.searchsorted(documents["token_start"], np.linspace(0, number_of_tokens, number_of_divisions + 1)[1:-1])
+    bounds = [0] + sorted(set(bounds.tolist()) - {0, len(documents)}) + [len(documents)]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_parsed_documents(parsed_path: str, first_document: int, end_document: int, batch_size: int = PARSE_BATCH_SIZE):
+    """
+    Yields batches of the ids and the tokens of the documents in a range of a parsed corpus
+    """
+
+    vocabulary, documents, tokens = load_parsed_corpus(parsed_path)
+
+    for batch_start in range(first_document, end_document, batch_size):
+        batch = documents[batch_start:min(batch_start + batch_size, end_document)]
+        if len(batch) == 0:
+            break
+
+        token_start = int(batch["token_start"][0])
+        token_end = int(batch["token_start"][-1]) + int(batch["token_count"][-1])
+        words = vocabulary[tokens[token_start:token_end]].tolist()
+
+        yield [(str(doc_id), words[start - token_start:start - token_start + count]) for doc_id, start, count in batch.tolist()]
+
+
+def read_parsed_texts(parsed_path: str):
+    """
+    Yields the id and the preprocessed text of every document of a parsed corpus
+    """
+
+    _, documents, _ = load_parsed_corpus(parsed_path)
+
+    for batch in read_parsed_documents(parsed_path, 0, len(documents)):
+        for doc_id, words in batch:
+            yield doc_id, " ".join(words)
+
+
+def main(corpus_path: str, parsed_path: str, number_of_threads: int):
+    """
+    Preprocesses the corpus in parallel once, so that the indexer and the notebooks can reuse its tokens
+    """
+
+    if not parsed_path.endswith("/"):
+        parsed_path += '/'
+
+    for folder in ("", "partitions/"):
+        if not os.path.isdir(parsed_path + folder):
+            os.mkdir(parsed_path + folder)
+
+    full_time = time.time()
+    partitions = partition_corpus(corpus_path, number_of_threads * PARTITIONS_PER_THREAD)
+
+    with Pool(number_of_threads) as pool:
+        pool.starmap(parse_partition, [(corpus_path, parsed_path, partition_idx, byte_start, byte_end) for partition_idx, (byte_start, byte_end) in enumerate(partitions)])
+
+    concatenates_partitions(parsed_path, len(partitions))
+
+    logging.info(f"Total time to parse corpus {corpus_path} to {parsed_path} with {number_of_threads} threads: {time.time() - full_time} seconds")
+
+
+# $ python3 bm_25_tf_idf/parsed_corpus.py -c data/corpus.jsonl -o data/parsed_corpus/ -t 8
+# $ python3 bm_25_tf_idf/indexer.py -c data/corpus.jsonl -r data/parsed_corpus/ -i indexer/
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Preprocesses the corpus to token id arrays.')
+
+    parser.add_argument('-c',dest='corpus_path',action='store',required=True,type=str)
+    parser.add_argument('-o',dest='parsed_path',action='store',required=True,type=str)
+    parser.add_argument('-t',dest='number_of_threads',action='store',required=False,type=int,default=8)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=f'main.log', level=logging.INFO)
+    main(args.corpus_path, args.parsed_path, args.number_of_threads)
@@ -0,0 +1,176 @@
+import os, time, logging, shutil
+
+import numpy as np
+
+from multiprocessing import Pool
+from postings import encode_positions, decode_position_block, decode_postings, BLOCK_SIZE
+from index_metadata import read_index_metadata, load_index_metadata, save_index_metadata
+from document_store import load_document_store, DocumentStore
+from document_lengths import load_document_lengths
+from lexicon import load_lexicon
+
+# Positions of the tokens of a document, counted over its preprocessed tokens
+POSITION_DTYPE = np.dtype(">u4")
+
+# Byte offset of the positional list of every term in the positional index, indexed by term id
+POSITION_OFFSETS_DTYPE = np.dtype(">u8")
+
+# Ranges of doc ids inverted in parallel, each holds the positions of its documents grouped by term
+POSITION_RANGES_PER_THREAD = 4
+
+
+def invert_position_range(index_path: str, range_idx: int, first_doc: int, end_doc: int, number_of_terms: int) -> None:
+    """
+    Groups by term the positions of the tokens of a range of doc ids, read from the document store,
+    keeping them in doc id and then position order within a term
+    """
+
+    seconds = time.time()
+    store = load_document_store(index_path)
+
+    token_ids = []; positions = []
+    for _, document_token_ids in store.iter_token_ids(first_doc, end_doc):
+        token_ids.append(document_token_ids.astype(np.int64))
+        positions.append(np.arange(len(document_token_ids), dtype=np.int64))
+
+    token_ids = np.concatenate(token_ids) if token_ids else np.empty(0, dtype=np.int64)
+    positions = np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+
+    range_path = index_path + f"position_ranges/{range_idx:04d}"
+    positions[np.argsort(token_ids, kind="stable")].astype(POSITION_DTYPE).tofile(range_path + ".positions")
+
+    # Start of the positions of every term in the range
+    term_starts = np.concatenate(([0], np.cumsum(np.bincount(token_ids, minlength=number_of_terms))))
+    term_starts.astype(POSITION_OFFSETS_DTYPE).tofile(range_path + ".starts")
+
+    logging.info(f"Time to invert the positions of documents {first_doc} to {end_doc}: {time.time() - seconds} seconds")
+
+
+def build_positional_index(index_path: str, number_of_threads: int) -> None:
+    """
+    Builds the positional index from the document store: the positions of the postings of every term in lexicon order,
+    in blocks that follow the blocks of the inverted index
+    """
+
+    seconds = time.time()
+    metadata = read_index_metadata(index_path)
+    block_size = metadata.get("block_size", BLOCK_SIZE)
+
+    with open(index_path + "term_lexicon.txt", 'r') as lexicon:
+        number_of_terms = sum(1 for _ in lexicon)
+
+    number_of_documents = len(load_document_store(index_path).offsets)
+    bounds = np.unique(np.linspace(0, number_of_documents, number_of_threads * POSITION_RANGES_PER_THREAD + 1).astype(np.int64))
+    ranges = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    if not os.path.isdir(index_path + "position_ranges/"):
+        os.mkdir(index_path + "position_ranges/")
+
+    with Pool(max(min(number_of_threads, len(ranges)), 1)) as pool:
+        pool.starmap(invert_position_range, [(index_path, range_idx, first_doc, end_doc, number_of_terms) for range_idx, (first_doc, end_doc) in enumerate(ranges)])
+
+    range_paths = [index_path + f"position_ranges/{range_idx:04d}" for range_idx in range(len(ranges))]
+    range_starts = [np.fromfile(range_path + ".starts", dtype=POSITION_OFFSETS_DTYPE).astype(np.int64) for range_path in range_paths]
+    range_positions = [DocumentStore.map_file(range_path + ".positions", POSITION_DTYPE) for range_path in range_paths]
+
+    byte_offsets = [0]
+    with open(index_path + "term_lexicon.txt", 'r') as lexicon, open(index_path + "inverted_index", 'rb') as index_file, open(index_path + "positional_index", 'wb') as output_file:
+        for term_id, line in enumerate(lexicon):
+            word, word_id, byte_start, byte_end = line.split(" ")[:4]
+
+            index_file.seek(int(byte_start))
+            _, _, freqs = decode_postings(index_file.read(int(byte_end) - int(byte_start)), metadata["format_version"], block_size)
+
+            # The ranges follow each other in doc id order, as the postings of the list
+            term_positions = np.concatenate([positions[starts[term_id]:starts[term_id + 1]] for positions, starts in zip(range_positions, range_starts)])
+
+            bin_array = encode_positions(term_positions, freqs, block_size)
+            output_file.write(bin_array)
+            byte_offsets.append(byte_offsets[-1] + len(bin_array))
+
+    np.array(byte_offsets, dtype=POSITION_OFFSETS_DTYPE).tofile(index_path + "positional_offsets")
+
+    del range_positions
+    shutil.rmtree(index_path + "position_ranges/")
+
+    save_index_metadata(index_path, {"positions": True, "positions_number_of_documents": number_of_documents})
+
+    logging.info(f"Time to build the positional index: {time.time() - seconds} seconds")
+
+
+def remove_positional_index(index_path: str) -> None:
+    """
+    Removes the positional index of an index built without positions, so that none is left from a previous build
+    """
+
+    for file_name in ("positional_index", "positional_offsets"):
+        if os.path.isfile(index_path + file_name):
+            os.remove(index_path + file_name)
+
+    save_index_metadata(index_path, {"positions": False})
+
+
+def has_positional_index(index_path: str) -> bool:
+    """
+    Whether the index was built with positions, with a positional index built for its documents and terms
+    """
+
+    metadata = load_index_metadata(index_path)
+    if not metadata.get("positions", False) or not os.path.isfile(os.path.join(index_path, "positional_offsets")):
+        return False
+
+    # Indexes built before the positions recorded their number of documents are only checked against the lexicon
+    _, number_of_documents, _ = load_document_lengths(index_path)
+    same_documents = metadata.get("positions_number_of_documents", number_of_documents) == number_of_documents
+    same_terms = os.path.getsize(os.path.join(index_path, "positional_offsets")) == (len(load_lexicon(index_path)) + 1) * POSITION_OFFSETS_DTYPE.itemsize
+
+    if not same_documents or not same_terms:
+        logging.warning(f"The positional index in {index_path} was built for another version of the index, it is not used")
+        return False
+
+    return True
+
+
+class PositionalIndex:
+    """
+    Positional lists of every term mapped into memory, only the blocks holding the postings asked for are decoded
+    """
+
+    def __init__(self, index_path: str):
+
+        self.block_size = load_index_metadata(index_path).get("block_size", BLOCK_SIZE)
+        self.offsets = DocumentStore.map_file(os.path.join(index_path, "positional_offsets"), POSITION_OFFSETS_DTYPE)
+        self.positions = DocumentStore.map_file(os.path.join(index_path, "positional_index"), np.uint8)
+
+
+    def get_positions(self, term_id: int, freqs: np.ndarray, posting_idxs: np.ndarray) -> list[np.ndarray]:
+        """
+        Returns the positions of some postings of the list of a term, given by their index in the list, freqs are the frequencies of the whole list
+        """
+
+        byte_array = self.positions[int(self.offsets[term_id]):int(self.offsets[term_id + 1])]
+
+        positions = []; blocks = {}
+        for posting_idx in np.asarray(posting_idxs).tolist():
+            block_idx = posting_idx // self.block_size
+            if block_idx not in blocks:
+                blocks[block_idx] = decode_position_block(byte_array, freqs, block_idx, self.block_size)
+
+            block_positions, posting_starts = blocks[block_idx]
+            posting_idx %= self.block_size
+            positions.append(block_positions[posting_starts[posting_idx]:posting_starts[posting_idx + 1]])
+
+        return positions
+
+
+_positional_indexes = {}
+
+def load_positional_index(index_path: str) -> PositionalIndex:
+    """
+    Returns the positional index, mapping it only once per worker, None for indexes built without positions or with a stale positional index
+    """
+
+    if index_path not in _positional_indexes:
+        _positional_indexes[index_path] = PositionalIndex(index_path) if has_positional_index(index_path) else None
+
+    return _positional_indexes[index_path]
@@ -0,0 +1,103 @@
+import os, threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+
+class PostingCache:
+    """
+    Least recently used cache of decoded inverted lists, bounded by the bytes of the arrays it holds
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The server answers queries from several threads
+        self.lock = threading.Lock()
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+    def is_enabled(self) -> bool:
+        return self.max_bytes > 0
+
+
+    def get(self, key) -> (np.ndarray, np.ndarray, int):
+        """
+        Returns the cached inverted list, None when it is not in the cache
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry
+
+
+    def put(self, key, doc_ids: np.ndarray, freqs: np.ndarray, tfc: int) -> None:
+        """
+        Caches an inverted list, evicting the least recently used ones until it fits in the budget
+        """
+
+        size = doc_ids.nbytes + freqs.nbytes
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            while self.used_bytes + size > self.max_bytes:
+                _, (evicted_doc_ids, evicted_freqs, _) = self.entries.popitem(last=False)
+                self.used_bytes -= evicted_doc_ids.nbytes + evicted_freqs.nbytes
+                self.evictions += 1
+
+            self.entries[key] = (doc_ids, freqs, tfc)
+            self.used_bytes += size
+
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache
+        """
+
+        return {
+            "pid": os.getpid(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "used_bytes": self.used_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+
+_posting_cache = PostingCache()
+
+def configure_posting_cache(max_bytes: int) -> None:
+    """
+    Replaces the posting cache of the worker with an empty one of the given budget, zero disables it
+    """
+
+    global _posting_cache
+    _posting_cache = PostingCache(max_bytes)
+
+
+def get_posting_cache() -> PostingCache:
+    """
+    Returns the posting cache of the worker
+    """
+
+    return _posting_cache
@@ -0,0 +1,462 @@
+import math
+
+import numpy as np
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+
+
+# Format 1: every posting is a 4 byte doc id followed by a 2 byte frequency, both big endian
+POSTING_DTYPE = np.dtype([("id", ">u4"), ("freq", ">u2")])
+HEADER_DTYPE = np.dtype(">u4")
+
+# Format 2: postings are grouped in blocks of doc id gaps and frequencies compressed with variable byte,
+# every list starts with a table holding the last doc id and the byte offset of each block
+# Format 3: same blocks, with the table entries also holding the highest frequency of the block
+BLOCK_HEADER_DTYPES = {
+    2: np.dtype([("last_id", ">u4"), ("offset", ">u4")]),
+    3: np.dtype([("last_id", ">u4"), ("offset", ">u4"), ("max_freq", ">u4")]),
+}
+BLOCK_SIZE = 128
+
+# Format written by default by the merger
+FORMAT_VERSION = 3
+
+# Returned by cursors once they go past the last posting, greater than any doc id
+END_OF_LIST = 1 << 32
+
+# Impact ordered lists: a table of segments sharing the same quantized score, highest first,
+# each holding the variable byte gaps of its doc ids
+IMPACT_SEGMENT_DTYPE = np.dtype([("impact", ">u2"), ("count", ">u4"), ("offset", ">u4")])
+
+# Positional lists: a table with the byte offset of the positions of every block of postings of the inverted list,
+# each holding the variable byte gaps between the positions of a posting, the frequencies of the list give their count
+POSITION_BLOCK_DTYPE = np.dtype(">u4")
+
+
+def vbyte_lengths(values: np.ndarray) -> np.ndarray:
+    """
+    Returns the number of bytes each value takes when variable byte encoded
+    """
+
+    return 1 + sum((values >= (1 << shift)).astype(np.int64) for shift in range(7, 64, 7))
+
+
+def vbyte_encode(values: np.ndarray) -> bytes:
+    """
+    Variable byte encodes non negative integers, 7 bits per byte with the high bit marking the last byte
+    """
+
+    values = np.asarray(values, dtype=np.uint64)
+    number_of_bytes = vbyte_lengths(values)
+
+    ends = np.cumsum(number_of_bytes)
+    byte_positions = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - number_of_bytes, number_of_bytes)
+
+    encoded = (np.repeat(values, number_of_bytes) >> (7 * byte_positions).astype(np.uint64)) & 0x7f
+    encoded[ends - 1] |= 0x80
+
+    return encoded.astype(np.uint8).tobytes()
+
+
+def vbyte_decode(byte_array: bytes) -> np.ndarray:
+    """
+    Decodes a sequence of variable byte encoded integers
+    """
+
+    encoded = np.frombuffer(byte_array, dtype=np.uint8)
+    if len(encoded) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    ends = np.flatnonzero(encoded & 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    byte_positions = np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)
+
+    values = (encoded & 0x7f).astype(np.uint64) << (7 * byte_positions).astype(np.uint64)
+
+    return np.add.reduceat(values, starts).astype(np.int64)
+
+
+def encode_raw_postings(word_id: int, doc_ids: np.ndarray, freqs: np.ndarray) -> bytes:
+    """
+    Encodes a word id and its postings to fixed width binary
+    """
+
+    postings = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+    postings["id"] = doc_ids
+    postings["freq"] = freqs
+
+    header = np.array([word_id, len(doc_ids)], dtype=HEADER_DTYPE)
+
+    return header.tobytes() + postings.tobytes()
+
+
+def decode_raw_postings(byte_array: bytes) -> (int, np.ndarray, np.ndarray):
+    """
+    Decodes a fixed width byte array into a word id and the parallel doc id and frequency arrays
+    """
+
+    word_id, number_of_docs = np.frombuffer(byte_array, dtype=HEADER_DTYPE, count=2)
+    postings = np.frombuffer(byte_array, dtype=POSTING_DTYPE, count=number_of_docs, offset=2 * HEADER_DTYPE.itemsize)
+
+    return int(word_id), postings["id"].astype(np.int64), postings["freq"].astype(np.int64)
+
+
+def encode_block_postings(word_id: int, doc_ids: np.ndarray, freqs: np.ndarray, format_version: int = FORMAT_VERSION, block_size: int = BLOCK_SIZE) -> bytes:
+    """
+    Encodes a word id and its postings as blocks of variable byte doc id gaps and frequencies
+    """
+
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    freqs = np.asarray(freqs, dtype=np.int64)
+    gaps = np.diff(doc_ids, prepend=0)
+
+    number_of_blocks = math.ceil(len(doc_ids) / block_size)
+    block_starts = np.arange(number_of_blocks) * block_size
+    block_lens = np.minimum(block_size, len(doc_ids) - block_starts)
+
+    # Lays out every block as its gaps followed by its frequencies
+    posting_block = np.arange(len(doc_ids)) // block_size
+    gap_positions = block_starts[posting_block] + np.arange(len(doc_ids))
+    values = np.empty(2 * len(doc_ids), dtype=np.uint64)
+    values[gap_positions] = gaps
+    values[gap_positions + block_lens[posting_block]] = freqs
+
+    block_bytes = np.add.reduceat(vbyte_lengths(values), 2 * block_starts) if number_of_blocks else block_starts
+
+    block_headers = np.empty(number_of_blocks, dtype=BLOCK_HEADER_DTYPES[format_version])
+    block_headers["last_id"] = doc_ids[block_starts + block_lens - 1]
+    block_headers["offset"] = np.cumsum(block_bytes) - block_bytes
+    if "max_freq" in block_headers.dtype.names:
+        block_headers["max_freq"] = np.maximum.reduceat(freqs, block_starts) if number_of_blocks else block_starts
+
+    header = np.array([word_id, len(doc_ids), number_of_blocks], dtype=HEADER_DTYPE)
+
+    return header.tobytes() + block_headers.tobytes() + vbyte_encode(values)
+
+
+def decode_block_postings(byte_array: bytes, format_version: int = FORMAT_VERSION, block_size: int = BLOCK_SIZE) -> (int, np.ndarray, np.ndarray):
+    """
+    Decodes all the blocks of a compressed byte array into a word id and the parallel doc id and frequency arrays
+    """
+
+    word_id, number_of_docs, number_of_blocks = np.frombuffer(byte_array, dtype=HEADER_DTYPE, count=3)
+    blocks_start = 3 * HEADER_DTYPE.itemsize + int(number_of_blocks) * BLOCK_HEADER_DTYPES[format_version].itemsize
+
+    values = vbyte_decode(byte_array[blocks_start:])
+
+    # Every block holds its gaps followed by its frequencies, the last block may be shorter than the others
+    number_of_full_blocks = int(number_of_docs) // block_size
+    full_blocks = values[:2 * number_of_full_blocks * block_size].reshape(number_of_full_blocks, 2, block_size)
+    last_block = values[2 * number_of_full_blocks * block_size:].reshape(2, -1)
+
+    gaps = np.concatenate((full_blocks[:, 0].ravel(), last_block[0]))
+    freqs = np.concatenate((full_blocks[:, 1].ravel(), last_block[1]))
+
+    return int(word_id), np.cumsum(gaps), freqs
+
+
+def encode_postings(word_id: int, doc_ids: np.ndarray, freqs: np.ndarray, format_version: int = 1) -> bytes:
+    """
+    Encodes a word id and its postings with the given index format
+    """
+
+    if format_version == 1:
+        return encode_raw_postings(word_id, doc_ids, freqs)
+
+    return encode_block_postings(word_id, doc_ids, freqs, format_version)
+
+
+def decode_postings(byte_array: bytes, format_version: int = 1, block_size: int = BLOCK_SIZE) -> (int, np.ndarray, np.ndarray):
+    """
+    Decodes a byte array written with the given index format
+    """
+
+    if format_version == 1:
+        return decode_raw_postings(byte_array)
+
+    return decode_block_postings(byte_array, format_version, block_size)
+
+
+def encode_impact_postings(doc_ids: np.ndarray, impacts: np.ndarray) -> bytes:
+    """
+    Encodes the postings of a word in segments of decreasing impact, postings with no impact are left out
+    """
+
+    has_impact = impacts > 0
+    doc_ids = doc_ids[has_impact]; impacts = impacts[has_impact]
+
+    order = np.lexsort((doc_ids, -impacts))
+    doc_ids = doc_ids[order]; impacts = impacts[order]
+
+    segment_starts = np.flatnonzero(np.diff(impacts, prepend=-1))
+    segment_counts = np.diff(segment_starts, append=len(doc_ids))
+
+    # Gaps restart at every segment
+    gaps = np.diff(doc_ids, prepend=0)
+    gaps[segment_starts] = doc_ids[segment_starts]
+
+    segment_bytes = np.add.reduceat(vbyte_lengths(gaps.astype(np.uint64)), segment_starts) if len(doc_ids) else segment_starts
+
+    segments = np.empty(len(segment_starts), dtype=IMPACT_SEGMENT_DTYPE)
+    segments["impact"] = impacts[segment_starts]
+    segments["count"] = segment_counts
+    segments["offset"] = np.cumsum(segment_bytes) - segment_bytes
+
+    header = np.array([len(segments)], dtype=HEADER_DTYPE)
+
+    return header.tobytes() + segments.tobytes() + vbyte_encode(gaps)
+
+
+def read_impact_segments(byte_array: bytes) -> (np.ndarray, memoryview):
+    """
+    Reads the segment table of an impact ordered list, returning it with the encoded segments
+    """
+
+    if len(byte_array) == 0:
+        return np.empty(0, dtype=IMPACT_SEGMENT_DTYPE), memoryview(b"")
+
+    number_of_segments = int(np.frombuffer(byte_array, dtype=HEADER_DTYPE, count=1)[0])
+    segments = np.frombuffer(byte_array, dtype=IMPACT_SEGMENT_DTYPE, count=number_of_segments, offset=HEADER_DTYPE.itemsize)
+
+    return segments, memoryview(byte_array)[HEADER_DTYPE.itemsize + number_of_segments * IMPACT_SEGMENT_DTYPE.itemsize:]
+
+
+def decode_impact_segment(segments: np.ndarray, encoded_segments: memoryview, segment_idx: int) -> np.ndarray:
+    """
+    Decodes the doc ids of one segment of an impact ordered list
+    """
+
+    segment_start = int(segments["offset"][segment_idx])
+    segment_end = int(segments["offset"][segment_idx + 1]) if segment_idx + 1 < len(segments) else len(encoded_segments)
+
+    return np.cumsum(vbyte_decode(encoded_segments[segment_start:segment_end]))
+
+
+def encode_positions(positions: np.ndarray, freqs: np.ndarray, block_size: int = BLOCK_SIZE) -> bytes:
+    """
+    Encodes the positions of every posting of a list in blocks of block_size postings, the positions of a posting are in increasing order
+    """
+
+    positions = np.asarray(positions, dtype=np.int64)
+    posting_starts = np.cumsum(freqs) - freqs
+
+    # Gaps restart at every posting
+    gaps = np.diff(positions, prepend=0)
+    gaps[posting_starts] = positions[posting_starts]
+
+    value_bytes = vbyte_lengths(gaps.astype(np.uint64))
+    block_offsets = (np.cumsum(value_bytes) - value_bytes)[posting_starts[::block_size]]
+
+    header = np.array([len(block_offsets)], dtype=HEADER_DTYPE)
+
+    return header.tobytes() + block_offsets.astype(POSITION_BLOCK_DTYPE).tobytes() + vbyte_encode(gaps)
+
+
+def decode_position_block(byte_array: bytes, freqs: np.ndarray, block_idx: int, block_size: int = BLOCK_SIZE) -> (np.ndarray, np.ndarray):
+    """
+    Decodes the positions of the postings of one block of a positional list, freqs are the frequencies of the whole list,
+    returns them one posting after the other with the start of every posting and the end of the last one
+    """
+
+    number_of_blocks = int(np.frombuffer(byte_array, dtype=HEADER_DTYPE, count=1)[0])
+    block_offsets = np.frombuffer(byte_array, dtype=POSITION_BLOCK_DTYPE, count=number_of_blocks, offset=HEADER_DTYPE.itemsize)
+    blocks = memoryview(byte_array)[HEADER_DTYPE.itemsize + number_of_blocks * POSITION_BLOCK_DTYPE.itemsize:]
+
+    block_start = int(block_offsets[block_idx])
+    block_end = int(block_offsets[block_idx + 1]) if block_idx + 1 < number_of_blocks else len(blocks)
+    gaps = vbyte_decode(blocks[block_start:block_end])
+
+    block_freqs = np.asarray(freqs[block_idx * block_size:(block_idx + 1) * block_size], dtype=np.int64)
+    posting_starts = np.concatenate(([0], np.cumsum(block_freqs)))
+
+    # Prefix sums of the whole block, restarted at every posting
+    positions = np.cumsum(gaps)
+    positions -= np.repeat(positions[posting_starts[:-1]] - gaps[posting_starts[:-1]], block_freqs)
+
+    return positions, posting_starts
+
+
+class PostingCursor(ABC):
+    """
+    Walks a posting list block by block, only decoding the blocks it stops at, subclasses decode the blocks of their list
+    """
+
+    def __init__(self, block_last_ids: np.ndarray, block_max_freqs: np.ndarray, number_of_docs: int):
+
+        self.block_last_ids = block_last_ids.tolist()
+        self.block_max_freqs = block_max_freqs.tolist() if block_max_freqs is not None else None
+        self.number_of_docs = number_of_docs
+
+        self.move_to_block(0)
+
+
+    def __len__(self) -> int:
+        return self.number_of_docs
+
+
+    @abstractmethod
+    def decode_block(self, block_idx: int) -> (np.ndarray, np.ndarray):
+        """
+        Returns the doc ids and the frequencies of a block of the list
+        """
+
+
+    def move_to_block(self, block_idx: int) -> None:
+        """
+        Decodes the given block and points the cursor to its first posting
+        """
+
+        self.block_idx = block_idx
+        self.position = 0
+
+        if block_idx >= len(self.block_last_ids):
+            self.block_doc_ids = []; self.block_freqs = []
+            self.current_doc = END_OF_LIST
+            return
+
+        doc_ids, freqs = self.decode_block(block_idx)
+        self.block_doc_ids = doc_ids.tolist(); self.block_freqs = freqs.tolist()
+        self.current_doc = self.block_doc_ids[0]
+
+
+    def doc(self) -> int:
+        """
+        Returns the doc id the cursor points to, END_OF_LIST once the list is exhausted
+        """
+
+        return self.current_doc
+
+
+    def freq(self) -> int:
+        """
+        Returns the frequency of the posting the cursor points to
+        """
+
+        return self.block_freqs[self.position]
+
+
+    def block_max_freq(self) -> int:
+        """
+        Returns the highest frequency of the current block, None when the index does not store it
+        """
+
+        if self.block_max_freqs is None or self.current_doc == END_OF_LIST:
+            return None
+
+        return self.block_max_freqs[self.block_idx]
+
+
+    def block_bound(self, target: int) -> (int, int):
+        """
+        Returns the last doc id and the highest frequency of the block that would hold target, without decoding it
+        """
+
+        block_idx = bisect_left(self.block_last_ids, target, self.block_idx)
+        if block_idx >= len(self.block_last_ids):
+            return END_OF_LIST, 0
+
+        if self.block_max_freqs is None:
+            return self.block_last_ids[block_idx], None
+
+        return self.block_last_ids[block_idx], self.block_max_freqs[block_idx]
+
+
+    def next(self) -> int:
+        """
+        Moves to the next posting and returns its doc id
+        """
+
+        if self.current_doc == END_OF_LIST:
+            return END_OF_LIST
+
+        self.position += 1
+        if self.position == len(self.block_doc_ids):
+            self.move_to_block(self.block_idx + 1)
+        else:
+            self.current_doc = self.block_doc_ids[self.position]
+
+        return self.current_doc
+
+
+    def advance(self, target: int) -> int:
+        """
+        Moves to the first posting with doc id greater or equal to target, skipping whole blocks through their last doc id
+        """
+
+        if target <= self.current_doc:
+            return self.current_doc
+
+        if target > self.block_last_ids[self.block_idx]:
+            self.move_to_block(bisect_left(self.block_last_ids, target, self.block_idx + 1))
+            if self.current_doc == END_OF_LIST:
+                return END_OF_LIST
+
+        self.position = bisect_left(self.block_doc_ids, target, self.position)
+        self.current_doc = self.block_doc_ids[self.position]
+
+        return self.current_doc
+
+
+class ArrayCursor(PostingCursor):
+    """
+    Cursor over a posting list that is already decoded, split in virtual blocks
+    """
+
+    def __init__(self, doc_ids: np.ndarray, freqs: np.ndarray, block_size: int = BLOCK_SIZE):
+
+        self.doc_ids = doc_ids
+        self.freqs = freqs
+        self.block_size = block_size
+
+        block_starts = np.arange(0, len(doc_ids), block_size)
+        block_last_ids = doc_ids[np.minimum(block_starts + block_size, len(doc_ids)) - 1]
+        block_max_freqs = np.maximum.reduceat(freqs, block_starts) if len(doc_ids) else freqs
+
+        super().__init__(block_last_ids, block_max_freqs, len(doc_ids))
+
+
+    def decode_block(self, block_idx: int) -> (np.ndarray, np.ndarray):
+        block = slice(block_idx * self.block_size, (block_idx + 1) * self.block_size)
+        return self.doc_ids[block], self.freqs[block]
+
+
+class BlockCursor(PostingCursor):
+    """
+    Cursor over a compressed posting list, reading the block table and decoding blocks on demand
+    """
+
+    def __init__(self, byte_array: bytes, format_version: int = FORMAT_VERSION):
+
+        word_id, number_of_docs, number_of_blocks = np.frombuffer(byte_array, dtype=HEADER_DTYPE, count=3)
+
+        block_header_dtype = BLOCK_HEADER_DTYPES[format_version]
+        block_headers = np.frombuffer(byte_array, dtype=block_header_dtype, count=number_of_blocks, offset=3 * HEADER_DTYPE.itemsize)
+
+        self.blocks = memoryview(byte_array)[3 * HEADER_DTYPE.itemsize + int(number_of_blocks) * block_header_dtype.itemsize:]
+        self.block_offsets = block_headers["offset"].tolist() + [len(self.blocks)]
+
+        block_max_freqs = block_headers["max_freq"] if "max_freq" in block_header_dtype.names else None
+
+        super().__init__(block_headers["last_id"].astype(np.int64), block_max_freqs, int(number_of_docs))
+
+
+    def decode_block(self, block_idx: int) -> (np.ndarray, np.ndarray):
+        values = vbyte_decode(self.blocks[self.block_offsets[block_idx]:self.block_offsets[block_idx + 1]])
+        block_len = len(values) // 2
+
+        previous_last_id = self.block_last_ids[block_idx - 1] if block_idx > 0 else 0
+
+        return np.cumsum(values[:block_len]) + previous_last_id, values[block_len:]
+
+
+def open_cursor(byte_array: bytes, format_version: int = 1, block_size: int = BLOCK_SIZE) -> PostingCursor:
+    """
+    Returns a cursor over a byte array written with the given index format
+    """
+
+    if format_version == 1:
+        word_id, doc_ids, freqs = decode_raw_postings(byte_array)
+        return ArrayCursor(doc_ids, freqs, block_size)
+
+    return BlockCursor(byte_array, format_version)
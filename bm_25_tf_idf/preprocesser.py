@@ -1,31 +1,73 @@
 import json, os, math, subprocess, re, nltk, time, logging
 
+from functools import lru_cache
 from nltk.stem.snowball import SnowballStemmer
-from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 
 nltk.download('stopwords')
 stop_words = set(stopwords.words('english'))
-nltk.download('punkt')
+
+# Maximum number of distinct tokens whose stem is kept in memory
+STEM_CACHE_SIZE = 1 << 20
+
+PUNCTUATION_REGEX = re.compile(r'[^\w\s]')
+
+# Once the punctuation is gone word_tokenize only splits the text on whitespace and breaks these words in two
+CONTRACTIONS = [("can", "not", r"\b"), ("gim", "me", r"\b"), ("gon", "na", r"\b"), ("got", "ta", r"\b"), ("lem", "me", r"\b"), ("wan", "na", r"(?!\S)")]
+CONTRACTION_REGEX = "|".join(rf"\b({first})({second}){end}" for first, second, end in CONTRACTIONS)
+NEXT_CONTRACTION_REGEX = "|".join(rf"\b{first}{second}{end}" for first, second, end in CONTRACTIONS)
+# A token is either a contraction, matched as its two halves, or a run of non whitespace characters up to the next contraction
+TOKEN_REGEX = re.compile(rf"{CONTRACTION_REGEX}|(?:(?!{NEXT_CONTRACTION_REGEX})\S)+", re.IGNORECASE)
+
+snow_stemmer = SnowballStemmer(language='english')
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word: str) -> str:
+    """
+    Stems a token, memoized since the vocabulary is much smaller than the number of tokens
+    """
+
+    return snow_stemmer.stem(word)
+
+
+def tokenize(text: str) -> list:
+    """
+    Lower cases the text and splits it in tokens the same way word_tokenize does once the punctuation is removed
+    """
+
+    tokens = []
+    for match in TOKEN_REGEX.finditer(PUNCTUATION_REGEX.sub(' ', text).lower()):
+        if match.lastindex is None:
+            tokens.append(match.group())
+        else:
+            tokens.extend((match.group(match.lastindex - 1), match.group(match.lastindex)))
+
+    return tokens
 
 
 def preprocesser(text: str) -> list:
     """
     Does stemming and removes stopwords and punctuation
     """
-    
-    snow_stemmer = SnowballStemmer(language='english')
-    
-    text = re.sub(r'\n|\r', ' ', text)       #Removes breaklines
-    text = re.sub(r'[^\w\s]', ' ', text)       #Removes punctuation
-    words = word_tokenize(text.lower())       #Tokenizes the text
 
-    filtered_sentence = []
-    for w in words:
-        if w not in stop_words:
-            filtered_sentence.append(snow_stemmer.stem(w))
+    return [stem(w) for w in tokenize(text) if w not in stop_words]
 
-    return filtered_sentence
+
+def preprocess_many(texts: list[str]) -> list[list]:
+    """
+    Preprocesses a batch of texts, sharing the stemmer and its memo table
+    """
+
+    return [preprocesser(text) for text in texts]
+
+
+def get_document_text(doc: dict) -> str:
+    """
+    Returns the text of a document of the corpus that gets indexed
+    """
+
+    return doc['text'] + " " +  doc["title"] + " "+ " ".join(doc['keywords'])
 
 
 def get_word_frequency(cleaned_text: list) -> dict:
@@ -42,22 +84,36 @@ def get_word_frequency(cleaned_text: list) -> dict:
     return word_freq
 
 
-def breaks_corpus(corpus_path: str, index_path: str, number_of_divisions: int) -> str:
+def partition_corpus(corpus_path: str, number_of_divisions: int) -> list[(int, int)]:
     """
-    Will read the jsonl file and break it into smaller chunks
+    Splits the jsonl file in byte ranges of about the same size, each document belongs to the range its line starts in
     """
 
-    # number_of_documents = 4641784
-    number_of_documents = int(str(subprocess.check_output(f"wc -l {corpus_path}", shell=True), 'utf-8').split(" ")[0])
-    size_of_division = math.ceil(number_of_documents / number_of_divisions)
-    
-    if not os.path.isdir(index_path + "shards/"):
-        os.mkdir(index_path + "shards/") 
+    corpus_size = os.path.getsize(corpus_path)
+    size_of_division = math.ceil(corpus_size / number_of_divisions)
+
+    return [(byte_start, min(byte_start + size_of_division, corpus_size)) for byte_start in range(0, corpus_size, max(size_of_division, 1))]
+
+
+def read_partition(corpus_path: str, byte_start: int, byte_end: int):
+    """
+    Yields the documents whose line starts in the byte range of the corpus
+    """
+
+    with open(corpus_path, 'rb') as f:
+        f.seek(max(byte_start - 1, 0))
+        if byte_start > 0:
+            # The line going over the start belongs to the previous partition
+            f.readline()
+
+        while f.tell() < byte_end:
+            line = f.readline()
+            if not line:
+                break
 
-    subprocess.Popen(f'split --lines={size_of_division} --numeric-suffixes --suffix-length=2 {corpus_path} {index_path + "shards/"}t', shell=True)
+            if line.strip():
+                yield json.loads(line, strict=False)
 
-    return index_path + "shards/"
-          
 
 def get_term_lexicon(corpus_path: str, index_path):
     """
@@ -1,12 +1,17 @@
-import sys, resource, argparse, os, logging, json, os, math, subprocess, time
+import sys, resource, argparse, os, logging, json, os, math, time
 
 from collections import OrderedDict 
-from multiprocessing import Pool, set_start_method, Lock, Manager
-from preprocesser import preprocesser
+from functools import partial
+from multiprocessing import Pool, set_start_method
+from preprocesser import preprocess_many
 
 set_start_method("spawn")
 
-from document_matching import process_query
+from document_matching import process_query, process_query_batch, get_feature_header
+from posting_cache import configure_posting_cache
+from document_store import load_document_store
+from document_ids import get_corpus_id
+from index_segments import load_segments
 
 import sys
 sys.modules['__main__'].__file__ = 'ipython'
@@ -15,20 +20,37 @@ def load_queries(queries_path: str) -> [int, [str]]:
     """
     Loads the queries from the queries.txt file
     """
-    queries = []
+    query_ids, query_texts = [], []
     with open(queries_path, 'r') as f:
         for line_idx, query in enumerate(f):
             if line_idx == 0:
                 continue
             query_idx, query_text = query.split(",")
-            queries.append((query_idx, preprocesser(query_text)))
+            query_ids.append(query_idx)
+            query_texts.append(query_text)
 
-    return queries
+    return list(zip(query_ids, preprocess_many(query_texts)))
 
 
-def load_docs(index_path: str) -> dict[str, str]:
+def load_docs(index_path: str) -> dict[int, str]:
     """
-    Loads the document index from the document_index file
+    Loads the preprocessed text of every document from the document store by corpus id, single documents are read with
+    load_document_store(index_path).get_terms(get_doc_id(index_path, corpus_id)) instead
+    """
+
+    segments = load_segments(index_path)
+    if segments is not None:
+        return {corpus_id: " ".join(terms) for corpus_id, terms in segments.iter_documents()}
+
+    if not os.path.isfile(index_path + "document_store"):
+        return load_json_docs(index_path)
+
+    return {get_corpus_id(index_path, doc_id): " ".join(terms) for doc_id, terms in load_document_store(index_path).iter_documents()}
+
+
+def load_json_docs(index_path: str) -> dict[int, str]:
+    """
+    Loads the document index of indexes built before the document store
     """
 
     doc_index = {}
@@ -44,55 +66,93 @@ def load_docs(index_path: str) -> dict[str, str]:
 
 
 
-def load_doc_lens(index_path: str) -> dict[int, int]:
+def batch_queries(queries: list[(int, [str])], batch_size: int) -> list[list[(int, [str])]]:
     """
-    Loads the document lengths from the document_lengths file
+    Splits the queries in batches, queries with the same terms are put next to each other so that they share their inverted lists
     """
 
-    doc_lens = {}
-    with open(index_path + "document_lens", "r") as f:
-        for line in f:
-            doc_len = json.loads(line)
-            id = int(doc_len["id"])
-            length = int(doc_len["len"])
-            doc_lens[id] = length
+    queries = sorted(queries, key=lambda query: sorted(query[1]))
+
+    return [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+
+
+def print_cache_stats(cache_stats: list[dict]) -> None:
+    """
+    Sums the posting cache counters of the workers, from the last ones each worker returned
+    """
+
+    last_stats = {}
+    for stats in cache_stats:
+        if stats["pid"] not in last_stats or stats["hits"] + stats["misses"] > last_stats[stats["pid"]]["hits"] + last_stats[stats["pid"]]["misses"]:
+            last_stats[stats["pid"]] = stats
+
+    hits = sum(stats["hits"] for stats in last_stats.values())
+    misses = sum(stats["misses"] for stats in last_stats.values())
+    evictions = sum(stats["evictions"] for stats in last_stats.values())
+
+    print(f"Posting cache: {hits} hits, {misses} misses, {evictions} evictions, hit rate {hits/max(hits + misses, 1):.2%}")
+
+
+def write_results(output_path: str, header: str, query_ids: list[str], answers) -> None:
+    """
+    Writes the results of each query as they arrive, in query id order, holding back the ones that arrive before their turn
+    """
+
+    query_order = sorted(query_ids)
+    next_query = 0
+    pending = {}
+
+    with open(output_path, 'w', buffering=1024 * 1024) as f:
+        f.write(header + "\n")
+
+        for query_idx, results in answers:
+            pending[query_idx] = results
 
-    return doc_lens
+            while next_query < len(query_order) and query_order[next_query] in pending:
+                query_idx = query_order[next_query]
+                f.writelines(f"{query_idx},{','.join(map(str, row))}\n" for row in pending.pop(query_idx))
+                next_query += 1
 
 
-def main(index_path: str, queries_path: str, ranker: str, matching: str, number_of_threads: int, cut_number: int):
+def main(index_path: str, queries_path: str, ranker: str, matching: str, number_of_threads: int, cut_number: int, postings_budget: int, batch_size: int, cache_size: int):
     """
     Your main calls should be added here
     """
 
     queries = load_queries(queries_path)
-    doc_lens = load_doc_lens(index_path)
 
-    results_folder = f"./results/{ranker}_output/"
-    
-    if not os.path.isdir(results_folder):
-        os.mkdir(results_folder) 
+    queries_path_without_extension = os.path.basename(queries_path).split("_")[0]
+    if matching == "features":
+        # Every ranker and matching at once, the ranker is ignored
+        output_path = f"results/{queries_path_without_extension}_features.csv"
+        header = get_feature_header(index_path)
+    else:
+        output_path = f"results/{queries_path_without_extension}_{matching}_{ranker}_scores.csv"
+        header = f"QueryId,EntityId,Relevance {'C' if matching.startswith('conjuntive') else 'D'}_{ranker}"
 
-    with Manager() as manager:
+    os.makedirs("results", exist_ok=True)
 
-        index_lock = manager.Lock()
-        lexicon_lock = manager.Lock()
-        
-        with Pool(number_of_threads) as pool:
-            pool.starmap(process_query, [(index_path, query, doc_lens, matching, ranker, cut_number, index_lock, lexicon_lock) for query in queries])
+    if batch_size:
+        tasks = batch_queries(queries, batch_size)
+        process = partial(process_query_batch, index_path, matching=matching, ranker=ranker, cut=cut_number, postings_budget=postings_budget)
+    else:
+        tasks = queries
+        process = partial(process_query, index_path, matching=matching, ranker=ranker, cut=cut_number, postings_budget=postings_budget)
 
+    cache_stats = []
 
-    queries_path_without_extension = queries_path.split("/")[1].split("_")[0]
-    print(queries_path_without_extension)
+    def stream_answers():
+        for answers, stats in pool.imap_unordered(process, tasks, chunksize=max(1, len(tasks) // (number_of_threads * 4))):
+            cache_stats.append(stats)
+            yield from answers
 
-    print(f"Saving results on results/{queries_path_without_extension}_{matching}_{ranker}_scores.csv")
-    subprocess.Popen(f"cat {results_folder}* > results/{queries_path_without_extension}_{matching}_{ranker}_scores.csv", shell=True)
+    print(f"Saving results on {output_path}")
 
-    time.sleep(10)
+    with Pool(number_of_threads, initializer=configure_posting_cache, initargs=(cache_size * 1024 * 1024,)) as pool:
+        write_results(output_path, header, [query_idx for query_idx, _ in queries], stream_answers())
 
-    for file in os.listdir(results_folder):
-        os.remove(os.path.join(results_folder, file))
-    os.rmdir(results_folder)
+    if cache_size:
+        print_cache_stats(cache_stats)
 
 
 # $ python3 processor.py -i <INDEX> -q <QUERIES> -r <RANKER>
@@ -106,8 +166,11 @@ if __name__ == "__main__":
     parser.add_argument('-m',dest='matching',action='store',required=False,type=str,default="conjuntive_daat")
     parser.add_argument('-t',dest='number_of_threads',action='store',required=False,type=int,default=12)
     parser.add_argument('-k',dest='cut_number',action='store',required=False,type=int,default=100000)
+    parser.add_argument('-p',dest='postings_budget',action='store',required=False,type=int,default=None)
+    parser.add_argument('-b',dest='batch_size',action='store',required=False,type=int,default=0)
+    parser.add_argument('-c',dest='cache_size',action='store',required=False,type=int,default=0)
 
     args = parser.parse_args()
 
-    main(args.index_path, args.queries_path, args.ranker, args.matching, args.number_of_threads, args.cut_number)
+    main(args.index_path, args.queries_path, args.ranker, args.matching, args.number_of_threads, args.cut_number, args.postings_budget, args.batch_size, args.cache_size)
 
@@ -0,0 +1,174 @@
+import argparse, os, logging, json, time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from preprocesser import preprocesser
+from lexicon import load_lexicon
+from index_metadata import load_index_metadata
+from document_lengths import load_document_lengths
+from document_matching import rank_query, retrieve_word_bytes, resolve_index
+from posting_cache import configure_posting_cache, get_posting_cache
+from document_store import load_document_store
+from document_ids import load_document_ids, get_doc_id
+from index_segments import refresh_segments
+
+RANKERS = ("BM25", "TFIDF")
+MATCHINGS = ("conjuntive_daat", "disjunctive_daat", "conjuntive_taat", "disjunctive_taat", "wand", "bmw", "maxscore", "saat")
+
+
+def load_index(index_path: str) -> None:
+    """
+    Loads the lexicon, the metadata, the document lengths and maps the index files of every segment once for the whole server
+    """
+
+    index_path, segments = resolve_index(index_path)
+
+    for segment_path in ([index_path] if segments is None else segments.paths):
+        load_lexicon(segment_path)
+        load_index_metadata(segment_path)
+        load_document_lengths(segment_path)
+        load_document_ids(segment_path)
+
+        if os.path.isfile(os.path.join(segment_path, "document_store")):
+            load_document_store(segment_path)
+
+        for index_file in ('inverted_index', 'impact_index'):
+            index_file_path = os.path.join(segment_path, index_file)
+            if os.path.isfile(index_file_path) and os.path.getsize(index_file_path) > 0:
+                retrieve_word_bytes(index_file_path, 0, 0)
+
+
+def find_document(index_path: str, corpus_id: int) -> (str, int):
+    """
+    Returns the segment holding a document and its doc id in the segment, None when it is not in the index
+    """
+
+    refresh_segments(index_path)
+    index_path, segments = resolve_index(index_path)
+    if segments is not None:
+        return segments.find(corpus_id)
+
+    doc_id = get_doc_id(index_path, corpus_id)
+
+    return (index_path, doc_id) if doc_id is not None else None
+
+
+def make_handler(index_path: str, default_cut: int):
+    """
+    Builds the request handler bound to the index loaded at startup
+    """
+
+    class SearchHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status: int, body: dict) -> None:
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+
+        def do_GET(self):
+            try:
+                self.answer_get()
+            except Exception as error:
+                # The client gets an answer even when a query fails unexpectedly, instead of a dropped connection
+                logging.exception(f"Request {self.path} failed")
+                self.send_json(500, {"error": f"internal error: {error!r}"})
+
+
+        def answer_get(self):
+            url = urlparse(self.path)
+            if url.path == "/stats":
+                self.send_json(200, get_posting_cache().stats())
+                return
+
+            if url.path == "/document":
+                self.send_document(parse_qs(url.query).get("id", [""])[0])
+                return
+
+            if url.path != "/search":
+                self.send_json(404, {"error": f"unknown path {url.path}"})
+                return
+
+            params = parse_qs(url.query)
+            text = params.get("q", [""])[0]
+            ranker = params.get("ranker", ["BM25"])[0]
+            matching = params.get("matching", ["conjuntive_daat"])[0]
+
+            if ranker not in RANKERS or matching not in MATCHINGS:
+                self.send_json(400, {"error": f"unknown ranker {ranker} or matching {matching}"})
+                return
+
+            try:
+                cut = int(params.get("k", [default_cut])[0])
+                seconds = time.time()
+                results = rank_query(index_path, preprocesser(text), matching, ranker, cut)
+            except ValueError as error:
+                self.send_json(400, {"error": str(error)})
+                return
+
+            logging.info(f"Query '{text}' answered in {time.time() - seconds} seconds")
+            self.send_json(200, {"query": text, "results": [{"id": doc_id, "score": score} for doc_id, score in results]})
+
+
+        def send_document(self, doc_id: str) -> None:
+            location = find_document(index_path, int(doc_id)) if doc_id.isdigit() else None
+            if location is not None and not os.path.isfile(os.path.join(location[0], "document_store")):
+                self.send_json(404, {"error": "the index has no document store"})
+                return
+
+            terms = load_document_store(location[0]).get_terms(location[1]) if location is not None else None
+            if terms is None:
+                self.send_json(404, {"error": f"unknown document {doc_id}"})
+                return
+
+            self.send_json(200, {"id": int(doc_id), "terms": terms})
+
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return SearchHandler
+
+
+def main(index_path: str, host: str, port: int, cut_number: int, cache_size: int):
+    """
+    Serves queries over HTTP from an index kept open for the lifetime of the process
+    """
+
+    seconds = time.time()
+    configure_posting_cache(cache_size * 1024 * 1024)
+    load_index(index_path)
+    logging.info(f"Index loaded in {time.time() - seconds} seconds")
+
+    server = ThreadingHTTPServer((host, port), make_handler(index_path, cut_number))
+    logging.info(f"Serving on http://{host}:{port}/search")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# $ python3 server.py -i <INDEX> -p 8080
+# $ curl "http://localhost:8080/search?q=<QUERY>&ranker=BM25&matching=wand&k=100"
+# $ curl "http://localhost:8080/document?id=<DOC_ID>"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serves the retriever as a persistent daemon.')
+
+    parser.add_argument('-i',dest='index_path',action='store',required=True,type=str)
+    parser.add_argument('-H',dest='host',action='store',required=False,type=str,default="localhost")
+    parser.add_argument('-p',dest='port',action='store',required=False,type=int,default=8080)
+    parser.add_argument('-k',dest='cut_number',action='store',required=False,type=int,default=100)
+    parser.add_argument('-c',dest='cache_size',action='store',required=False,type=int,default=0)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    main(args.index_path, args.host, args.port, args.cut_number, args.cache_size)
@@ -0,0 +1,67 @@
+import os, sys, json, threading, subprocess
+
+import pytest
+
+from http.server import ThreadingHTTPServer
+from urllib.request import urlopen
+from urllib.parse import quote
+
+from server import load_index, make_handler
+
+CORPUS = [
+    {"id": "1", "title": "Retrieval of documents", "text": "Inverted indexes make the retrieval of documents fast.", "keywords": ["index"]},
+    {"id": "2", "title": "Ranking", "text": "BM25 ranks the documents holding the query terms.", "keywords": ["ranking"]},
+    {"id": "3", "title": "Compression", "text": "Posting lists are compressed in blocks of doc ids.", "keywords": []},
+]
+
+
+@pytest.fixture(scope="module")
+def server_url(tmp_path_factory):
+    """
+    Builds a small index with indexer.py and serves it on a free port for the tests of the module
+    """
+
+    work_path = tmp_path_factory.mktemp("server")
+    corpus_path = work_path / "corpus.jsonl"
+    corpus_path.write_text("".join(json.dumps(doc) + "\n" for doc in CORPUS))
+
+    index_path = str(work_path / "index") + "/"
+    indexer_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexer.py")
+    subprocess.run([sys.executable, indexer_path, "-c", str(corpus_path), "-i", index_path, "-t", "1"], cwd=work_path, check=True, capture_output=True)
+
+    load_index(index_path)
+    server = ThreadingHTTPServer(("localhost", 0), make_handler(index_path, 10))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://localhost:{server.server_address[1]}"
+
+    server.shutdown()
+    server.server_close()
+
+
+def search(server_url: str, query: str, matching: str) -> (int, dict):
+    with urlopen(f"{server_url}/search?q={quote(query)}&matching={matching}") as response:
+        return response.status, json.load(response)
+
+
+@pytest.mark.parametrize("matching", ["conjuntive_daat", "disjunctive_daat", "conjuntive_taat", "wand", "bmw", "maxscore"])
+def test_stop_word_query_has_no_results(server_url, matching):
+    status, body = search(server_url, "the of and", matching)
+
+    assert status == 200
+    assert body["results"] == []
+
+
+def test_unknown_terms_have_no_results(server_url):
+    status, body = search(server_url, "zzqxv qqwzx", "conjuntive_daat")
+
+    assert status == 200
+    assert body["results"] == []
+
+
+def test_query_is_ranked(server_url):
+    status, body = search(server_url, "documents", "disjunctive_daat")
+
+    assert status == 200
+    assert sorted(result["id"] for result in body["results"]) == [1, 2]
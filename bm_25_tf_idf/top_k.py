@@ -0,0 +1,77 @@
+import heapq, math
+
+import numpy as np
+
+
+class TopK:
+    """
+    Streaming top k selection of (score, doc id) pairs over a bounded min heap,
+    ties are broken by the highest doc id, or by the highest tie key of the doc id when tie_keys is given
+    """
+
+    def __init__(self, k: int, tie_keys: np.ndarray = None):
+        self.k = k
+        self.heap = []
+        self.tie_keys = tie_keys
+
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+
+    def is_full(self) -> bool:
+        return len(self.heap) >= self.k
+
+
+    def threshold(self) -> float:
+        """
+        Returns the lowest score a document needs to enter the selection
+        """
+
+        if self.k <= 0:
+            return math.inf
+
+        return self.heap[0][0] if self.is_full() else -math.inf
+
+
+    def push(self, score: float, doc_id: int) -> None:
+        """
+        Offers a document to the selection, replacing the lowest one when it is full
+        """
+
+        entry = (score, doc_id) if self.tie_keys is None else (score, self.tie_keys.item(doc_id), doc_id)
+
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+
+        elif self.k > 0 and entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+
+    def results(self) -> list[(int, float)]:
+        """
+        Returns the selected documents in descending order of score
+        """
+
+        return [(entry[-1], entry[0]) for entry in sorted(self.heap, reverse=True)]
+
+
+def select_top_k(doc_ids: np.ndarray, scores: np.ndarray, k: int, tie_keys: np.ndarray = None) -> list[(int, float)]:
+    """
+    Batch top k selection with argpartition, returning the same documents in the same order as TopK
+    """
+
+    if k <= 0 or len(scores) == 0:
+        return []
+
+    if len(scores) > k:
+        # Every document scoring at least the k-th highest score, ties at the boundary are resolved below
+        threshold = scores[np.argpartition(scores, len(scores) - k)[len(scores) - k]]
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+
+    ties = doc_ids[candidates] if tie_keys is None else tie_keys[doc_ids[candidates]]
+    best = candidates[np.lexsort((ties, scores[candidates]))[::-1][:k]]
+
+    return list(zip(doc_ids[best].tolist(), scores[best].tolist()))